@@ -1,4 +1,5 @@
-import ast, os, time, rpyc, csv, socket, random, datetime
+import ast, os, time, rpyc, csv, json, struct, socket, random, datetime, queue, threading, secrets, atexit
+from collections import deque
 
 host = os.getenv("SERVER_HOST", "server")
 port = int(os.getenv("RPYC_PORT", "18861"))
@@ -11,6 +12,20 @@ TWO_PASSES = bool(int(os.getenv("TWO_PASSES", "0")))
 INFINITE_REQUESTS = bool(int(os.getenv("INF_PASS", "0")))
 TIME_BETWEEN = float(os.getenv("TIME_BETWEEN", "3"))
 SAMPLE_SIZE = int(os.getenv("SAMPLE_SIZE", "5"))
+BATCH = bool(int(os.getenv("BATCH", "0")))  # send a whole pass as one count_many request
+PROTOCOL = os.getenv("PROTOCOL", "rpyc").lower()  # 'rpyc', 'json' (SERVER_MODE=async) or 'binary'
+BINARY_PORT = int(os.getenv("BINARY_PORT", "9001"))  # binary listener (LB or server) for PROTOCOL=binary
+ROUTE_HINT = bool(int(os.getenv("ROUTE_HINT", "0")))  # send ROUTE/HEDGE lines first; only for an LB with ALGO=hash
+HEDGE = bool(int(os.getenv("HEDGE", "0")))  # race a duplicate count on a second connection when the first is slow
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))  # hedge once a request outlives this latency percentile...
+HEDGE_MIN_DELAY_MS = float(os.getenv("HEDGE_MIN_DELAY_MS", "10"))  # ...but never sooner than this
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.05"))  # hedges allowed per request (0.05 = at most 5% extra)
+TRACING = bool(int(os.getenv("TRACING", "0")))  # trace requests end to end; only through an LB with TRACING=1
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "1"))  # share of requests traced
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "redis")  # where client spans go: 'redis' or a JSON-lines file path
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")  # span stream for TRACE_EXPORT=redis
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+TRACE_STREAM = "trace:spans"
 
 # Load random tests
 with open("word_list") as f:
@@ -18,20 +33,325 @@ with open("word_list") as f:
 tests = [ast.literal_eval(random.choice(options).strip()) for _ in range(SAMPLE_SIZE)]
 
 
+class JsonConn:
+    """Newline-delimited JSON connection to a SERVER_MODE=async server.
+
+    Mirrors the bits of an rpyc connection the client uses (conn.root.count,
+    conn.root.count_many, conn.close) so the request loops stay the same.
+    """
+
+    def __init__(self, host, port, hint=b""):
+        self.sock = socket.create_connection((host, port))
+        if hint:
+            self.sock.sendall(hint)
+        self.f = self.sock.makefile("rwb")
+        self.root = self
+
+    def call(self, op, **args):
+        self.f.write(json.dumps(dict(op=op, **args)).encode() + b"\n")
+        self.f.flush()
+        line = self.f.readline()
+        if not line:
+            raise ConnectionError("server closed the connection")
+        resp = json.loads(line)
+        if isinstance(resp, dict) and "error" in resp:
+            raise RuntimeError(resp["error"])
+        return resp
+
+    def count(self, fname, kw, trace=None):
+        if trace:
+            return self.call("count", file=fname, keyword=kw, trace=trace)
+        return self.call("count", file=fname, keyword=kw)
+
+    def count_many(self, pairs):
+        return self.call("count_many", pairs=[list(p) for p in pairs])
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+
+class BinaryConn:
+    """Client for the server's length-prefixed binary protocol (see server.py).
+
+    count_many pipelines one COUNT frame per pair over the connection and
+    matches the replies back by request id.
+    """
+    OP_COUNT = 2
+
+    def __init__(self, host, port, hint=b""):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hint:
+            self.sock.sendall(hint)
+        self.f = self.sock.makefile("rwb")
+        self.root = self
+        self.next_id = 0
+
+    @staticmethod
+    def _str(value):
+        data = value.encode("utf-8")
+        return struct.pack(">H", len(data)) + data
+
+    def _send_count(self, fname, kw, trace=None):
+        self.next_id += 1
+        body = struct.pack(">IB", self.next_id, self.OP_COUNT) + self._str(fname) + self._str(kw)
+        if trace:
+            body += self._str(trace)
+        self.f.write(struct.pack(">I", len(body)) + body)
+        return self.next_id
+
+    def _recv(self):
+        head = self.f.read(4)
+        if len(head) < 4:
+            raise ConnectionError("server closed the connection")
+        (n,) = struct.unpack(">I", head)
+        body = self.f.read(n)
+        rid, status = struct.unpack_from(">IB", body)
+        if status != 0:
+            (m,) = struct.unpack_from(">H", body, 5)
+            raise RuntimeError(body[7:7 + m].decode("utf-8"))
+        cnt, from_cache = struct.unpack_from(">IB", body, 5)
+        (m,) = struct.unpack_from(">H", body, 10)
+        return rid, {"count": cnt, "from_cache": bool(from_cache),
+                     "server": body[12:12 + m].decode("utf-8")}
+
+    def count(self, fname, kw, trace=None):
+        self._send_count(fname, kw, trace)
+        self.f.flush()
+        return self._recv()[1]
+
+    def count_many(self, pairs):
+        ids = [self._send_count(fname, kw) for fname, kw in pairs]
+        self.f.flush()
+        replies = dict(self._recv() for _ in ids)
+        return [(replies[i]["count"], replies[i]["from_cache"], replies[i]["server"]) for i in ids]
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+
+def connect(route=None, trace=None, hedge=False):
+    # route=(fname, kw): with ROUTE_HINT the LB reads this line to pick the
+    # backend that owns the key. Binary frames carry the key, so no hint there.
+    # hedge: with ROUTE_HINT a HEDGE line sends the connection to the key's
+    # next owner, away from the one the slow first attempt went to.
+    # trace: a TRACE line ahead of it tells the LB to record its spans under the id.
+    hint = f"TRACE {trace}\n".encode() if trace else b""
+    if ROUTE_HINT and hedge:
+        hint += b"HEDGE 1\n"
+    if PROTOCOL == "binary":
+        return BinaryConn(host, BINARY_PORT, hint)
+    if ROUTE_HINT and route:
+        hint += f"ROUTE {route[0]}:{route[1].lower()}\n".encode()
+    if PROTOCOL == "json":
+        return JsonConn(host, port, hint)
+    if not hint:
+        return rpyc.connect(host, port)
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.sendall(hint)
+    return rpyc.connect_stream(rpyc.SocketStream(sock))
+
+
+class Spans:
+    """Client-side trace spans, shipped in batches by a background thread.
+
+    Same flat span dicts as the LB and servers (trace, name, svc, ts, ms, ...),
+    so client/trace_waterfall.py can line all three up per request.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.r = None
+        if TRACE_EXPORT == "redis":
+            import redis
+            self.r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, socket_timeout=2)
+
+    def add(self, trace, name, start, end, **attrs):
+        span = {"trace": trace, "name": name, "svc": CLIENT_ID,
+                "ts": f"{time.time() - (time.perf_counter() - start):.6f}",
+                "ms": f"{(end - start) * 1000.0:.3f}"}
+        span.update((k, str(v)) for k, v in attrs.items())
+        with self.lock:
+            self.pending.append(span)
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            if self.r is not None:
+                pipe = self.r.pipeline(transaction=False)
+                for span in batch:
+                    pipe.xadd(TRACE_STREAM, span, maxlen=100000, approximate=True)
+                pipe.execute()
+            else:
+                with open(TRACE_EXPORT, "a") as f:
+                    f.writelines(json.dumps(span) + "\n" for span in batch)
+        except Exception as e:
+            self.dropped += len(batch)
+            print(f"{CLIENT_ID} span export failed: {e}", flush=True)
+
+    def flush_loop(self):
+        while True:
+            time.sleep(1.0)
+            self.flush()
+
+
+spans = Spans() if TRACING else None
+if TRACING:
+    threading.Thread(target=spans.flush_loop, daemon=True).start()
+    atexit.register(spans.flush)
+
+
+def new_trace():
+    # trace id for one request, or None when it isn't sampled
+    if TRACING and random.random() < TRACE_SAMPLE:
+        return secrets.token_hex(8)
+    return None
+
+
+def call_count(c, fname, kw, trace=None):
+    # rpyc servers take the trace id as an optional third argument
+    if trace:
+        return c.root.count(fname, kw, trace)
+    return c.root.count(fname, kw)
+
+
+class Hedger:
+    """Sends a second copy of a slow count() and keeps whichever reply lands first.
+
+    count is idempotent, so the duplicate is harmless. It goes out on a fresh
+    connection, marked as a hedge so a hashing LB skips the key's owner, once the
+    first attempt has outlived the HEDGE_PERCENTILE of recent latencies. Every request
+    earns HEDGE_BUDGET of a token and a hedge spends a whole one, so hedging
+    can't add more than that share of load even when every server is slow.
+    """
+
+    def __init__(self):
+        self.recent = deque(maxlen=200)
+        self.tokens = 0.0
+        self.hedges = 0
+        self.wins = 0
+
+    def delay(self):
+        if len(self.recent) < 20 or self.tokens < 1.0:
+            return None   # no baseline yet, or out of budget: just wait
+        xs = sorted(self.recent)
+        p = xs[min(len(xs) - 1, int(len(xs) * HEDGE_PERCENTILE / 100))]
+        return max(p, HEDGE_MIN_DELAY_MS) / 1000.0
+
+    def count(self, conn, fname, kw, trace=None):
+        """conn.root.count(fname, kw) as a plain dict, and whether the hedge won.
+
+        The caller still closes conn; a hedge connection is closed here, which
+        abandons whichever attempt lost.
+        """
+        self.tokens = min(self.tokens + HEDGE_BUDGET, 1.0 + HEDGE_BUDGET)
+        replies = queue.Queue()
+
+        def attempt(c, hedge):
+            try:
+                r = call_count(c, fname, kw, trace)
+                replies.put((dict(count=r["count"], from_cache=r["from_cache"], server=r["server"]), hedge, None))
+            except Exception as e:
+                replies.put((None, hedge, e))
+
+        t0 = time.perf_counter()
+        threading.Thread(target=attempt, args=(conn, False), daemon=True).start()
+        pending, hedge_conn = 1, None
+        try:
+            try:
+                first = replies.get(timeout=self.delay())
+            except queue.Empty:
+                self.tokens -= 1.0
+                self.hedges += 1
+                hedge_conn = connect((fname, kw), trace, hedge=True)
+                threading.Thread(target=attempt, args=(hedge_conn, True), daemon=True).start()
+                pending = 2
+                first = replies.get()
+            while first[2] is not None and pending > 1:   # one failed: the other may still answer
+                pending -= 1
+                first = replies.get()
+        finally:
+            if hedge_conn is not None:
+                try:
+                    hedge_conn.close()
+                except Exception:
+                    pass
+        resp, hedged, err = first
+        if err is not None:
+            raise err
+        self.recent.append((time.perf_counter() - t0) * 1000.0)
+        self.wins += hedged
+        return resp, hedged
+
+
+hedger = Hedger()
+
+
+def count_one(conn, fname, kw, trace=None):
+    # (resp, hedged); resp may be a netref dict when not hedging
+    t0 = time.perf_counter()
+    if HEDGE:
+        resp, hedged = hedger.count(conn, fname, kw, trace)
+    else:
+        resp, hedged = call_count(conn, fname, kw, trace), False
+    if trace:
+        spans.add(trace, "client.count", t0, time.perf_counter(), file=fname, keyword=kw,
+                  server=resp["server"], hedged=hedged)
+    return resp, hedged
+
+
+def traced_connect(route, trace):
+    t0 = time.perf_counter()
+    conn = connect(route, trace)
+    if trace:
+        spans.add(trace, "client.connect", t0, time.perf_counter(), protocol=PROTOCOL)
+    return conn
+
+
 def sleep_with_jitter():
     jitter = (random.random() - 0.5) * (TIME_BETWEEN * 0.2)
     time.sleep(max(0.0, TIME_BETWEEN + jitter))
 
 def run_batch(passno: int):
     rows = []
-    if CONNECT_EACH:
+    if BATCH:
+        sleep_with_jitter()
+        conn = connect()
+        try:
+            t_start = datetime.datetime.utcnow().isoformat()
+            t0 = time.perf_counter()
+            # tuples of str go over the wire by value, so this is one round trip
+            resps = conn.root.count_many(tuple(tests))
+            dt_ms = (time.perf_counter() - t0) * 1000.0
+            for i, ((fname, kw), (cnt, from_cache, server)) in enumerate(zip(tests, resps), 1):
+                print(
+                    f"client={CLIENT_ID} pass={passno} req={i}/{len(tests)} "
+                    f"file={fname:6s} kw={kw:8s} count={cnt:5d} "
+                    f"cache={from_cache} server={server} "
+                    f"latency={dt_ms:.2f}ms (batch)",
+                    flush=True
+                )
+                rows.append([passno, CLIENT_ID, t_start, fname, kw,
+                             cnt, from_cache, server, dt_ms, "", ""])   # hedged: n/a for a batch
+        finally:
+            conn.close()
+    elif CONNECT_EACH:
         for i, (fname, kw) in enumerate(tests, 1):
             sleep_with_jitter()
-            conn = rpyc.connect(host, port)
+            trace = new_trace()
+            conn = traced_connect((fname, kw), trace)
             try:
                 t_start = datetime.datetime.utcnow().isoformat()
                 t0 = time.perf_counter()
-                resp = conn.root.count(fname, kw)  # resp may be a netref dict
+                resp, hedged = count_one(conn, fname, kw, trace)  # resp may be a netref dict
                 dt_ms = (time.perf_counter() - t0) * 1000.0
 
                 # Use resp WHILE conn is still open:
@@ -39,19 +359,21 @@ def run_batch(passno: int):
                     f"client={CLIENT_ID} pass={passno} req={i}/{len(tests)} "
                     f"file={fname:6s} kw={kw:8s} count={resp['count']:5d} "
                     f"cache={resp['from_cache']} server={resp['server']} "
-                    f"latency={dt_ms:.2f}ms",
+                    f"latency={dt_ms:.2f}ms" + (" (hedge won)" if hedged else "")
+                    + (f" trace={trace}" if trace else ""),
                     flush=True
                 )
                 rows.append([passno, CLIENT_ID, t_start, fname, kw,
-                             resp['count'], resp['from_cache'], resp['server'], dt_ms])
+                             resp['count'], resp['from_cache'], resp['server'], dt_ms, hedged, trace or ""])
             finally:
                 conn.close()
     else:
-        conn = rpyc.connect(host, port)
+        conn = connect()
         try:
             for i, (fname, kw) in enumerate(tests, 1):
                 t_start = datetime.datetime.utcnow().isoformat()
                 t0 = time.perf_counter()
+                # no hedging on a shared connection: a losing attempt would leave its reply in flight
                 resp = conn.root.count(fname, kw)
                 dt_ms = (time.perf_counter() - t0) * 1000.0
                 print(
@@ -62,7 +384,7 @@ def run_batch(passno: int):
                     flush=True
                 )
                 rows.append([passno, CLIENT_ID, t_start, fname, kw,
-                             resp['count'], resp['from_cache'], resp['server'], dt_ms])
+                             resp['count'], resp['from_cache'], resp['server'], dt_ms, "", ""])
         finally:
             conn.close()
     return rows
@@ -72,14 +394,16 @@ def infinite_requests():
     while True:
         sleep_with_jitter()
         (fname, kw) = ast.literal_eval(random.choice(options).strip())
-        conn = rpyc.connect(host, port)
+        trace = new_trace()
+        conn = traced_connect((fname, kw), trace)
         try:
             t0 = time.perf_counter()
-            resp = conn.root.count(fname, kw)
+            resp, hedged = count_one(conn, fname, kw, trace)
             dt_ms = (time.perf_counter() - t0) * 1000.0
             print(
                 f"client={CLIENT_ID}, file={fname:6s} kw={kw:8s} count={resp['count']:5d} "
-                f"cache={resp['from_cache']} server={resp['server']}, latency={dt_ms:.2f}ms",
+                f"cache={resp['from_cache']} server={resp['server']}, latency={dt_ms:.2f}ms"
+                + (" (hedge won)" if hedged else "") + (f" trace={trace}" if trace else ""),
                 flush=True
             )
         finally:
@@ -93,6 +417,9 @@ else:
     if TWO_PASSES:
         all_rows += run_batch(2)
 
+if HEDGE:
+    print(f"{CLIENT_ID} hedged {hedger.hedges} request(s), the hedge won {hedger.wins}", flush=True)
+
 # Write one CSV per client container
 if os.getenv("SAVE_CSV", "1") == "1" and not INFINITE_REQUESTS:
     os.makedirs("/results", exist_ok=True)
@@ -100,6 +427,6 @@ if os.getenv("SAVE_CSV", "1") == "1" and not INFINITE_REQUESTS:
     with open(outfile, "w", newline="") as f:
         w = csv.writer(f)
         w.writerow(["pass", "client_id", "t_start_utc", "file", "keyword",
-                    "count", "from_cache", "server", "latency_ms"])
+                    "count", "from_cache", "server", "latency_ms", "hedged", "trace_id"])
         w.writerows(all_rows)
     print(f"wrote {outfile}", flush=True)
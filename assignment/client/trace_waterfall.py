@@ -0,0 +1,91 @@
+"""Rebuild per-request waterfalls from the trace spans of clients, LBs and servers.
+
+    python trace_waterfall.py                  # the 5 slowest traces in the stream
+    python trace_waterfall.py --slowest 20
+    python trace_waterfall.py 3f9c0a7e12b4d8c1 # one trace (id from the client log or CSV)
+    python trace_waterfall.py --file spans.jsonl
+
+Spans come from the trace:spans Redis stream (REDIS_HOST/REDIS_PORT) or from
+JSON-lines files written with TRACE_EXPORT=<path>. Each span is drawn as a bar
+on the request's timeline and indented under the spans that contain it.
+Offsets across containers are only as good as their clocks agree, which on one
+Docker host is well under a millisecond.
+"""
+import argparse, json, os
+from collections import defaultdict
+
+TRACE_STREAM = "trace:spans"
+
+
+def load_redis(host, port, last):
+    import redis
+    r = redis.Redis(host=host, port=port, decode_responses=True)
+    return [fields for _, fields in r.xrevrange(TRACE_STREAM, count=last)]
+
+
+def load_files(paths):
+    spans = []
+    for path in paths:
+        with open(path) as f:
+            spans += [json.loads(line) for line in f if line.strip()]
+    return spans
+
+
+def group(spans):
+    traces = defaultdict(list)
+    for s in spans:
+        s["start"] = float(s["ts"]) * 1000.0
+        s["end"] = s["start"] + float(s["ms"])
+        traces[s["trace"]].append(s)
+    return traces
+
+
+def duration(spans):
+    return max(s["end"] for s in spans) - min(s["start"] for s in spans)
+
+
+def draw(trace, spans, width):
+    spans.sort(key=lambda s: (s["start"], -float(s["ms"])))
+    t0 = spans[0]["start"]
+    total = max(duration(spans), 1e-3)
+    print(f"trace {trace}  {total:.2f}ms  {len(spans)} span(s)")
+    for i, s in enumerate(spans):
+        # depth = how many earlier spans enclose this one (0.05ms slack for clock jitter)
+        depth = sum(1 for p in spans[:i] if p["start"] <= s["start"] + 0.05 and p["end"] >= s["end"] - 0.05)
+        lo = int((s["start"] - t0) / total * width)
+        n = max(1, int(round(float(s["ms"]) / total * width)))
+        bar = " " * lo + "#" * min(n, width - lo)
+        attrs = " ".join(f"{k}={v}" for k, v in s.items()
+                         if k not in ("trace", "name", "svc", "ts", "ms", "start", "end"))
+        label = "  " * depth + s["name"]
+        print(f"  {s['start'] - t0:8.2f} {float(s['ms']):8.2f}ms  {label:<28s} {s['svc']:<14.14s} "
+              f"|{bar:<{width}s}| {attrs}")
+    print()
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("traces", nargs="*", help="trace ids to show (default: the slowest)")
+    ap.add_argument("--slowest", type=int, default=5, help="how many of the slowest traces to show")
+    ap.add_argument("--file", action="append", help="read spans from a JSON-lines file instead of Redis")
+    ap.add_argument("--last", type=int, default=20000, help="newest stream entries to read")
+    ap.add_argument("--width", type=int, default=50, help="waterfall bar width")
+    args = ap.parse_args()
+
+    if args.file:
+        spans = load_files(args.file)
+    else:
+        spans = load_redis(os.getenv("REDIS_HOST", "redis"), int(os.getenv("REDIS_PORT", "6379")), args.last)
+    traces = group(spans)
+    if args.traces:
+        chosen = [t for t in args.traces if t in traces]
+        for t in set(args.traces) - set(chosen):
+            print(f"trace {t}: no spans found")
+    else:
+        chosen = sorted(traces, key=lambda t: duration(traces[t]), reverse=True)[:args.slowest]
+    for t in chosen:
+        draw(t, traces[t], args.width)
+
+
+if __name__ == "__main__":
+    main()
@@ -68,13 +68,12 @@ const gNodes = el("g");  // top layer (rects + labels)
 svg.append(gLinks, gDots, gNodes);
 
 // ------- SVG helpers & layout -------
+// backend nodes come from the snapshot (the LB's registry can add and remove them)
 const POS = {
   client: {x: 80,  y: 130, label:"Client"},
   lb:     {x: 240, y: 130, label:"LB"},
-  server1:{x: 440, y: 60,  label:"server1"},
-  server2:{x: 440, y: 130, label:"server2"},
-  server3:{x: 440, y: 200, label:"server3"},
 };
+let SERVERS = [];   // backend node ids currently drawn, in snapshot order
 
 const COLOR_MAP = {};
 
@@ -88,11 +87,13 @@ const NODE_TINT = {
   upStroke:     "#54f29c",
   downFill:     "#3a1d1d",
   downStroke:   "#ff6b6b",
+  drainFill:    "#3a301a",
+  drainStroke:  "#f2c454",
 };
 
 function setNodeTint(id, status) {
   // only tint server nodes; skip client/LB
-  if (!/^server/.test(id) || !NODE_ELEMS[id]) return;
+  if (!SERVERS.includes(id) || !NODE_ELEMS[id]) return;
   const { rect } = NODE_ELEMS[id];
   if (status === "up") {
     rect.setAttribute("fill",   NODE_TINT.upFill);
@@ -100,6 +101,9 @@ function setNodeTint(id, status) {
   } else if (status === "down") {
     rect.setAttribute("fill",   NODE_TINT.downFill);
     rect.setAttribute("stroke", NODE_TINT.downStroke);
+  } else if (status === "draining") {
+    rect.setAttribute("fill",   NODE_TINT.drainFill);
+    rect.setAttribute("stroke", NODE_TINT.drainStroke);
   } else {
     rect.setAttribute("fill",   NODE_TINT.neutralFill);
     rect.setAttribute("stroke", NODE_TINT.neutralStroke);
@@ -107,9 +111,7 @@ function setNodeTint(id, status) {
 }
 
 function resetServerTints() {
-  Object.keys(POS)
-    .filter(k => /^server/.test(k))
-    .forEach(k => setNodeTint(k, "neutral"));
+  SERVERS.forEach(k => setNodeTint(k, "neutral"));
 }
 
 
@@ -186,9 +188,29 @@ function animateHop(a, b, ms = 800, color = "#9fb0ff") {
   requestAnimationFrame(frame);
 }
 
-// initial paint
-["client","lb","server1","server2","server3"].forEach(drawNode);
-[["client","lb"],["lb","server1"],["lb","server2"],["lb","server3"]].forEach(([a,b])=>drawLink(a,b));
+// stack the backends in one column, growing the canvas past ~4 of them
+function layout(names) {
+  if (names.join("\\n") === SERVERS.join("\\n")) return;
+  for (const id of SERVERS) delete POS[id];
+  SERVERS = names;
+  const step = 70;
+  const height = Math.max(260, names.length * step + 50);
+  svg.setAttribute("viewBox", `0 0 800 ${height}`);
+  svg.style.height = `${height}px`;
+  POS.client.y = POS.lb.y = height / 2;
+  const top = height / 2 - (names.length - 1) * step / 2;
+  names.forEach((id, i) => { POS[id] = {x: 440, y: top + i * step, label: id}; });
+
+  gLinks.replaceChildren();
+  gNodes.replaceChildren();
+  for (const id in NODE_ELEMS) delete NODE_ELEMS[id];
+  ["client", "lb", ...names].forEach(drawNode);
+  drawLink("client", "lb");
+  names.forEach(id => drawLink("lb", id));
+}
+
+// initial paint; backends appear with the first snapshot
+layout([]);
 
 // ------- renderers -------
 function renderSnapshot(s) {
@@ -199,6 +221,7 @@ function renderSnapshot(s) {
   let backends = [];
   try { backends = JSON.parse(s.backends); } catch(e){ console.warn("Bad backends JSON", s.backends); }
 
+  layout(backends.map(b => b.name));
   // --- NEW: reset all server node tints before applying fresh state
   resetServerTints();
 
@@ -206,17 +229,24 @@ function renderSnapshot(s) {
   backends.forEach(b=>{
     const tr=document.createElement('tr');
     const healthy = !!(b.healthy === true || b.healthy === "true" || b.healthy === 1 || b.healthy === "1");
+    const status = b.draining ? "draining" : healthy ? "up" : "down";
     tr.innerHTML = `<td>${b.name}</td>
-                    <td class="${healthy?'ok':'down'}">${healthy?'UP':'DOWN'}</td>`;
+                    <td class="${healthy?'ok':'down'}">${b.draining ? `DRAINING (${b.conns})` : healthy?'UP':'DOWN'}</td>`;
     tbody.appendChild(tr);
 
     // --- NEW: tint matching server node if it exists in the diagram
-    if (POS[b.name]) setNodeTint(b.name, healthy ? "up" : "down");
+    if (POS[b.name]) setNodeTint(b.name, status);
   });
 }
 
 
 function appendTextEvent(d) {
+  if (d.type === "backend_join" || d.type === "backend_leave") {
+    const what = d.type === "backend_join" ? "joined" : `left, draining ${d.draining} connection(s)`;
+    const line = `[${new Date(parseFloat(d.ts||0)*1000).toLocaleTimeString()}] backend ${d.backend}:${d.port} ${what}`;
+    log.textContent = line + "\\n" + log.textContent;
+    return;
+  }
   if (d.type !== "end") return;
   const backend = d.backend ?? "server?";
   const port    = d.backend_port ?? "????";
@@ -0,0 +1,753 @@
+"""Backend selection shared by both LBs (load_balancer_FD.py, load_balancer_gui.py).
+
+Everything here sees backends by slot index: the consistent-hash ring,
+peak-EWMA/P2C picking, outlier ejection, admission control, the pre-dialed
+connection pool, health probes and the registry reader. Per-slot numbers live
+in tables the LB hands in, plain lists (Table) in the GUI LB, shared-memory
+arrays in the FD LB so its workers agree.
+"""
+import asyncio
+import bisect
+import contextlib
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import struct
+import time
+from collections import deque
+
+import redis
+import rpyc
+
+import tracing
+
+HC_INTERVAL = float(os.getenv("HC_INTERVAL", "2"))  # seconds between checks
+HC_TIMEOUT = float(os.getenv("HC_TIMEOUT", "1"))  # probe timeout (dial + readiness reply)
+HC_FALL = int(os.getenv("HC_FALL", "2"))  # mark DOWN after N fails
+HC_RISE = int(os.getenv("HC_RISE", "2"))  # mark UP after N passes
+HC_MODE = os.getenv("HC_MODE", "ready")  # tcp = port accepts; ready = OP_READY on the binary port (Redis + data dir)...
+HC_SERVICE = os.getenv("HC_SERVICE", "rpyc")  # ...plus the service port: rpyc/json = a ready() call (SERVER_MODE), tcp = accepts
+HC_JITTER = float(os.getenv("HC_JITTER", "0.2"))  # each probe waits HC_INTERVAL +/- this fraction
+
+ALGO = os.getenv("ALGO", "rr").lower()  # 'rr', 'lc', 'hash' or 'ewma'
+BINARY_BACKEND_PORT = int(os.getenv("BINARY_BACKEND_PORT", "18862"))  # servers' BINARY_PORT
+HASH_VNODES = int(os.getenv("HASH_VNODES", "100"))               # ring points per backend (ALGO=hash)
+HASH_PEEK_TIMEOUT = float(os.getenv("HASH_PEEK_TIMEOUT", "0.5"))  # wait for the routing key before falling back to rr
+POOL_REFILL_INTERVAL = float(os.getenv("POOL_REFILL_INTERVAL", "1"))  # seconds between pool top-ups
+EWMA_DECAY = float(os.getenv("EWMA_DECAY", "10"))                   # seconds for a backend's latency EWMA to forget (ALGO=ewma)
+SLOW_START = float(os.getenv("SLOW_START", "10"))                   # seconds to ramp a recovered backend to full share; 0 = off
+OUTLIER_CONSECUTIVE = int(os.getenv("OUTLIER_CONSECUTIVE", "5"))    # eject after N failures in a row
+OUTLIER_INTERVAL = float(os.getenv("OUTLIER_INTERVAL", "5"))        # seconds per error-rate / latency sweep
+OUTLIER_ERROR_RATE = float(os.getenv("OUTLIER_ERROR_RATE", "0.5"))  # eject above this failure ratio per sweep...
+OUTLIER_MIN_REQUESTS = int(os.getenv("OUTLIER_MIN_REQUESTS", "10")) # ...once a sweep saw at least this many requests
+OUTLIER_LATENCY_FACTOR = float(os.getenv("OUTLIER_LATENCY_FACTOR", "5"))  # eject when a sweep's median > factor x peers'...
+OUTLIER_SLOW_MS = float(os.getenv("OUTLIER_SLOW_MS", "50"))         # ...and above this floor
+OUTLIER_BASE_EJECT = float(os.getenv("OUTLIER_BASE_EJECT", "5"))    # first ejection (s); doubles each time
+OUTLIER_MAX_EJECT = float(os.getenv("OUTLIER_MAX_EJECT", "120"))    # longest ejection (s)
+OUTLIER_MAX_EJECT_PCT = float(os.getenv("OUTLIER_MAX_EJECT_PCT", "34"))  # cap on the share of backends ejected
+ADMISSION = bool(int(os.getenv("ADMISSION", "1")))               # per-backend limits + wait line; 0 = forward everything
+ADMIT_LIMIT_INIT = int(os.getenv("ADMIT_LIMIT_INIT", "32"))         # starting in-flight connections per backend
+ADMIT_LIMIT_MIN = int(os.getenv("ADMIT_LIMIT_MIN", "4"))
+ADMIT_LIMIT_MAX = int(os.getenv("ADMIT_LIMIT_MAX", "512"))
+ADMIT_TOLERANCE = float(os.getenv("ADMIT_TOLERANCE", "4"))          # RTT above this x recent minimum counts as queueing
+ADMIT_BACKOFF = float(os.getenv("ADMIT_BACKOFF", "0.9"))            # multiplicative decrease
+ADMIT_QUEUE = int(os.getenv("ADMIT_QUEUE", "256"))                  # connections allowed to wait for a slot
+ADMIT_DEADLINE = float(os.getenv("ADMIT_DEADLINE", "0.5"))          # seconds after accept before a waiter is shed
+
+REGISTRY = bool(int(os.getenv("REGISTRY", "0")))                 # 1 = backends come from the Redis registry, not BACKENDS
+REGISTRY_POLL = float(os.getenv("REGISTRY_POLL", "1"))           # seconds between registry reads
+REGISTRY_TTL = float(os.getenv("REGISTRY_TTL", "6"))             # a backend silent this long has left (same on the servers)
+REGISTRY_MAX_BACKENDS = int(os.getenv("REGISTRY_MAX_BACKENDS", "32"))  # table size; registry slots beyond it are ignored
+
+BACKENDS = [] if REGISTRY else [("server1", 18861), ("server2", 18861), ("server3", 18861)]
+CAPACITY = REGISTRY_MAX_BACKENDS if REGISTRY else len(BACKENDS)
+
+OP_READY = 3  # binary-protocol readiness op (server.py)
+ROUTE_PREFIX = b"ROUTE "  # client hint line: b"ROUTE <file>:<keyword>\n", stripped before forwarding
+HEDGE_PREFIX = b"HEDGE "  # client hint line: b"HEDGE 1\n" on a hedged duplicate, stripped too
+REGISTRY_KEY = "backends"            # sorted set: backend name -> last heartbeat (server.py)
+REGISTRY_ADDR_KEY = "backends:addr"  # hash: backend name -> "host:port"
+REGISTRY_SLOT_KEY = "backends:slot"  # hash: backend name -> slot, i.e. its index here
+
+
+class Table(list):
+    """One number per backend slot, for a single-process LB (SharedTable's interface)."""
+
+    def __init__(self, initial, typecode="q"):
+        super().__init__([initial] * CAPACITY)
+
+    def add(self, idx, delta):
+        self[idx] += delta
+
+
+def ring_hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring over backend indexes, HASH_VNODES points per backend.
+
+    Points are keyed by backend name, and an unhealthy backend is skipped
+    rather than removed, so only the keys it owned move to their next owner
+    clockwise.
+    """
+
+    def __init__(self, backends, vnodes):
+        points = sorted((ring_hash(f"{host}#{v}"), i)
+                        for i, (host, _) in enumerate(backends) for v in range(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.owners = [i for _, i in points]
+        self.size = len(backends)
+
+    def lookup(self, key: str, ok):
+        if not self.owners:
+            return None
+        start = bisect.bisect(self.hashes, ring_hash(key))
+        seen = set()
+        for j in range(len(self.owners)):
+            idx = self.owners[(start + j) % len(self.owners)]
+            if idx in seen:
+                continue
+            if ok(idx):
+                return idx
+            seen.add(idx)
+            if len(seen) == self.size:
+                break
+        return None
+
+
+class OutlierDetector:
+    """Passive health tracking from live traffic.
+
+    A backend is ejected after OUTLIER_CONSECUTIVE failures in a row (connect
+    errors/timeouts, resets, connections dropped mid-request), when its error
+    rate over the last OUTLIER_INTERVAL reaches OUTLIER_ERROR_RATE, or when its
+    median latency over that window is OUTLIER_LATENCY_FACTOR times the median of
+    its peers' (each needing OUTLIER_MIN_REQUESTS samples). The n-th
+    ejection lasts OUTLIER_BASE_EJECT * 2^(n-1) seconds, capped at
+    OUTLIER_MAX_EJECT, and at most OUTLIER_MAX_EJECT_PCT % of the pool is out at once.
+    """
+
+    def __init__(self, pool):
+        n = CAPACITY
+        self.pool = pool
+        self.consecutive = [0] * n
+        self.ok = [0] * n               # successes in the current window
+        self.failed = [0] * n           # failures in the current window
+        self.samples = [[] for _ in range(n)]   # request latencies (ms) in the current window
+        self.seen = [0] * n             # requests sampled in the current window
+        self.ejected_until = [0.0] * n
+        self.ejections = [0] * n        # drives the exponential back-off
+        self.last_ejected = [0.0] * n
+        self.reason = [""] * n
+
+    def ejected(self, idx):
+        return time.monotonic() < self.ejected_until[idx]
+
+    def max_ejected(self):
+        n = len(self.pool.backends) - len(self.pool.retired)
+        return max(1, int(n * OUTLIER_MAX_EJECT_PCT / 100)) if n > 1 else 0
+
+    def success(self, idx):
+        self.consecutive[idx] = 0
+        self.ok[idx] += 1
+
+    def sample(self, idx, ms):
+        window = self.samples[idx]
+        self.seen[idx] += 1
+        if len(window) < 1024:
+            window.append(ms)
+        else:
+            # reservoir: a busy backend keeps a uniform sample of its window
+            j = random.randrange(self.seen[idx])
+            if j < len(window):
+                window[j] = ms
+
+    def median(self, idx):
+        window = sorted(self.samples[idx])
+        return window[len(window) // 2] if len(window) >= OUTLIER_MIN_REQUESTS else None
+
+    def failure(self, idx, why):
+        self.consecutive[idx] += 1
+        self.failed[idx] += 1
+        if self.consecutive[idx] >= OUTLIER_CONSECUTIVE:
+            self.eject(idx, f"{self.consecutive[idx]} consecutive failures ({why})")
+
+    def eject(self, idx, reason):
+        now = time.monotonic()
+        if self.ejected(idx):
+            return
+        if sum(self.ejected(i) for i in range(len(self.pool.backends))) >= self.max_ejected():
+            return
+        if now - self.last_ejected[idx] > 2 * OUTLIER_MAX_EJECT:
+            self.ejections[idx] = 0   # behaved for a while: back-off starts over
+        self.ejections[idx] += 1
+        duration = min(OUTLIER_MAX_EJECT, OUTLIER_BASE_EJECT * 2 ** (self.ejections[idx] - 1))
+        self.ejected_until[idx] = now + duration
+        self.last_ejected[idx] = now
+        self.consecutive[idx] = 0
+        self.reason[idx] = reason
+        print(f"[LB] ejecting {self.pool.backends[idx][0]} for {duration:.0f}s: {reason}", flush=True)
+
+    def sweep(self):
+        live = [i for i in range(len(self.pool.backends)) if self.pool.live(i)]
+        for i in live:
+            total = self.ok[i] + self.failed[i]
+            if total >= OUTLIER_MIN_REQUESTS and self.failed[i] / total >= OUTLIER_ERROR_RATE:
+                self.eject(i, f"error rate {self.failed[i]}/{total}")
+        # this window's samples only: one slow request among many fast ones, or
+        # a slow spell that has already passed, does not eject
+        medians = {i: m for i in live if (m := self.median(i)) is not None}
+        if len(medians) > 2:
+            for i, lat in medians.items():
+                peers = sorted(m for j, m in medians.items() if j != i)
+                median = peers[len(peers) // 2]
+                if lat > OUTLIER_SLOW_MS and lat > OUTLIER_LATENCY_FACTOR * median:
+                    self.eject(i, f"median latency {lat:.0f}ms vs peers' {median:.0f}ms")
+        self.ok = [0] * len(self.ok)
+        self.failed = [0] * len(self.failed)
+        self.samples = [[] for _ in self.samples]
+        self.seen = [0] * len(self.seen)
+
+    def describe(self, idx):
+        left = self.ejected_until[idx] - time.monotonic()
+        return {"ejected": left > 0, "ejected_for_s": round(max(0.0, left), 1),
+                "ejections": self.ejections[idx], "eject_reason": self.reason[idx] if left > 0 else ""}
+
+
+class AdmissionControl:
+    """Adaptive per-backend connection limits and a bounded FIFO wait line.
+
+    Each backend's limit moves AIMD-style on request round trips: +1/limit per
+    sample while the limit is in use and the RTT stays under ADMIT_TOLERANCE x
+    the backend's recent minimum, x ADMIT_BACKOFF (at most every 100 ms) when
+    it doesn't. A connection that finds every backend at its limit waits in
+    line; it is shed with "Service unavailable" if the line already holds
+    ADMIT_QUEUE connections or ADMIT_DEADLINE passes after accept.
+    """
+
+    def __init__(self, pool):
+        n = CAPACITY
+        self.pool = pool
+        self.limit = [float(ADMIT_LIMIT_INIT)] * n
+        self.min_rtt = [math.inf] * n
+        self.cut_at = [0.0] * n
+        self.waiters = deque()
+        self.shed = 0
+
+    def has_room(self, idx):
+        return not ADMISSION or self.pool.conns[idx] < int(self.limit[idx])
+
+    def sample(self, idx, rtt_ms):
+        # the minimum creeps up so a stale best case ages out
+        self.min_rtt[idx] = min(self.min_rtt[idx] * 1.001, rtt_ms)
+        now = time.monotonic()
+        if rtt_ms > ADMIT_TOLERANCE * max(self.min_rtt[idx], 1.0):
+            if now - self.cut_at[idx] > 0.1:
+                self.limit[idx] = max(ADMIT_LIMIT_MIN, self.limit[idx] * ADMIT_BACKOFF)
+                self.cut_at[idx] = now
+        elif self.pool.conns[idx] >= self.limit[idx] / 2:
+            self.limit[idx] = min(ADMIT_LIMIT_MAX, self.limit[idx] + 1.0 / self.limit[idx])
+            self.release()
+
+    def release(self):
+        # a slot freed up (or a limit grew): wake the head of the line
+        while self.waiters:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+
+    async def admit(self, exclude, deadline):
+        """True once a backend outside `exclude` has room, or none is up at all
+        (pick() reports that); False when the connection is shed."""
+        pool = self.pool
+
+        def ready():
+            up = [i for i in range(len(pool.backends)) if i not in exclude and pool.live(i)]
+            return not up or any(self.has_room(i) for i in up)
+
+        if not ADMISSION or (not self.waiters and ready()):
+            return True
+        if len(self.waiters) >= ADMIT_QUEUE:
+            self.shed += 1
+            return False
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.waiters.append(fut)
+        try:
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    self.shed += 1
+                    return False
+                # short timeout: slots freed elsewhere (health, other workers) don't wake us
+                await asyncio.wait([fut], timeout=min(remaining, 0.05))
+                if fut.done() or self.waiters[0] is fut:
+                    if ready():
+                        return True
+                    if fut.done():
+                        # woken, but the slot went to someone else: stay first in line
+                        fut = loop.create_future()
+                        self.waiters.appendleft(fut)
+        finally:
+            with contextlib.suppress(ValueError):
+                self.waiters.remove(fut)
+
+    def describe(self, idx):
+        return {"limit": int(self.limit[idx])}
+
+
+class BackendConnPool:
+    """Pre-dialed idle TCP connections per backend address.
+
+    A client connection still gets a backend connection of its own (an rpyc
+    session is stateful and cannot share one), but it is handed over already
+    established, so the LB->backend handshake is off the request path. Idle
+    connections are evicted after POOL_IDLE_TIMEOUT or once the backend closes
+    them, and topped up in the background for healthy backends.
+    """
+
+    def __init__(self, size, idle_timeout):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.idle = {}   # (host, port) -> deque[(reader, writer, dialed_at)]
+        self.hits = 0
+        self.misses = 0
+        self._wake = asyncio.Event()
+
+    def _usable(self, reader, writer, dialed_at):
+        return (not reader.at_eof() and not writer.is_closing()
+                and time.monotonic() - dialed_at < self.idle_timeout)
+
+    async def acquire(self, host, port):
+        q = self.idle.get((host, port))
+        while q:
+            reader, writer, dialed_at = q.popleft()
+            if self._usable(reader, writer, dialed_at):
+                self.hits += 1
+                self._wake.set()
+                return reader, writer
+            writer.close()
+        self.misses += 1
+        return await asyncio.open_connection(host, port)
+
+    def drop(self, host, port):
+        for _, writer, _ in self.idle.pop((host, port), ()):
+            writer.close()
+
+    async def _fill(self, host, port):
+        q = self.idle.setdefault((host, port), deque())
+        for item in [c for c in q if not self._usable(*c)]:
+            q.remove(item)
+            item[1].close()
+        while len(q) < self.size:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port), timeout=HC_TIMEOUT)
+            except Exception:
+                return
+            q.append((reader, writer, time.monotonic()))
+
+    async def refill_loop(self, pool, ports):
+        while True:
+            fills = []
+            for i, (host, port) in enumerate(pool.backends):
+                for p in ports(port):
+                    if pool.health[i] and i not in pool.retired:
+                        fills.append(self._fill(host, p))
+                    else:
+                        self.drop(host, p)
+            with contextlib.suppress(Exception):
+                await asyncio.gather(*fills)
+            self._wake.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wake.wait(), POOL_REFILL_INTERVAL)
+
+
+class Pool:
+    """The backends, their health and load, and the routing decision.
+
+    `table(initial, typecode)` makes the per-slot tables that every process
+    must agree on: health, probe counters and in-flight connections.
+    `on_member(event, host, port, conns)` hears registry joins and leaves.
+    """
+
+    def __init__(self, backends, conn_pool, table=Table, tag="[LB]", on_member=None):
+        self.backends = backends
+        self.conn_pool = conn_pool
+        self.tag = tag
+        self.on_member = on_member
+        self._rr = itertools.cycle(range(len(backends)))
+        self.health = table(int(not REGISTRY))  # registry backends: set by sync
+        self.fails = table(0)
+        self.passes = table(0)
+        self.conns = table(0)                   # in-flight connections, across all workers
+        self.ring = HashRing(backends, HASH_VNODES)
+        self.ewma = [0.0] * CAPACITY            # peak-EWMA of request round trips (ms)
+        self.ewma_at = [0.0] * CAPACITY         # monotonic time of the last sample
+        self.up_since = table(0.0, "d")         # when the backend last came back (slow start)
+        self.probe_ms = table(0.0, "d")         # smoothed health-probe round trip (ms)
+        self.retired = set()                    # slots that left the registry: no new connections
+        self.changed = asyncio.Event()          # backends added or retired (wakes health_loop)
+        self.outliers = OutlierDetector(self)
+        self.admission = AdmissionControl(self)
+
+    def sync(self, members, initial, prober=True):
+        """Apply a registry read: `members` maps slot -> (host, port) of every
+        live backend. Backends from the LB's first read start up, later ones
+        start down and come in through health checks and slow start. A backend
+        that left is retired: it gets no new connections, the ones it has run
+        to completion, and its idle pooled connections are closed. Only the
+        prober (one per LB) writes the shared health tables and logs.
+        """
+        changed = False
+        for slot, addr in sorted(members.items()):
+            if slot >= CAPACITY:
+                print(f"{self.tag} ignoring {addr[0]}:{addr[1]}: slot {slot} >= REGISTRY_MAX_BACKENDS", flush=True)
+                continue
+            while len(self.backends) <= slot:
+                self.retired.add(len(self.backends))
+                self.backends.append((f"slot{len(self.backends)}", 0))
+            if self.backends[slot] == addr and slot not in self.retired:
+                continue
+            if self.backends[slot] != addr:
+                # a slot changes hands only after its owner was gone for a while
+                self.ewma[slot] = self.ewma_at[slot] = 0.0
+                self.outliers.ejected_until[slot] = 0.0
+                self.outliers.ejections[slot] = 0
+                self.admission.limit[slot] = float(ADMIT_LIMIT_INIT)
+                self.admission.min_rtt[slot] = math.inf
+            self.backends[slot] = addr
+            self.retired.discard(slot)
+            if prober:
+                self.health[slot] = initial
+                self.fails[slot] = self.passes[slot] = 0
+                self.probe_ms[slot] = 0.0
+                print(f"{self.tag} backend {addr[0]}:{addr[1]} joined (slot {slot})", flush=True)
+                if self.on_member:
+                    self.on_member("join", addr[0], addr[1], 0)
+            changed = True
+        for i, (host, port) in enumerate(self.backends):
+            if i not in members and i not in self.retired:
+                self.retired.add(i)
+                for p in (port, BINARY_BACKEND_PORT):
+                    self.conn_pool.drop(host, p)
+                if prober:
+                    self.health[i] = False
+                    print(f"{self.tag} backend {host}:{port} left; draining {self.conns[i]} connection(s)", flush=True)
+                    if self.on_member:
+                        self.on_member("leave", host, port, self.conns[i])
+                changed = True
+        if changed:
+            self.ring = HashRing(self.backends, HASH_VNODES)
+            self._rr = itertools.cycle(range(len(self.backends)))
+            self.changed.set()
+
+    async def probe(self, host, port):
+        # one health probe; returns its round trip (ms) or raises
+        t0 = time.perf_counter()
+        if HC_MODE == "ready":
+            # the binary listener has its own thread and loop in rpyc mode, so a
+            # wedged ThreadedServer still passes it: check the service port too
+            await self._probe_binary(host)
+            if HC_SERVICE == "rpyc":
+                await asyncio.to_thread(self._probe_rpyc, host, port)
+                return (time.perf_counter() - t0) * 1000.0
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            if HC_MODE == "ready" and HC_SERVICE == "json":
+                writer.write(b'{"op": "ready"}\n')
+                await writer.drain()
+                reply = json.loads(await reader.readline() or b"{}")
+                if not reply.get("ready"):
+                    raise RuntimeError("; ".join(reply.get("problems", [])) or reply.get("error", "not ready"))
+        finally:
+            writer.close()
+        return (time.perf_counter() - t0) * 1000.0
+
+    @staticmethod
+    async def _probe_binary(host):
+        reader, writer = await asyncio.open_connection(host, BINARY_BACKEND_PORT)
+        try:
+            # u32 length | u32 id | u8 op; status byte 1 carries the reason
+            writer.write(struct.pack(">IIB", 5, 0, OP_READY))
+            await writer.drain()
+            (n,) = struct.unpack(">I", await reader.readexactly(4))
+            body = await reader.readexactly(n)
+            if body[4] != 0:
+                raise RuntimeError(body[7:].decode(errors="replace"))
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _probe_rpyc(host, port):
+        # blocking (runs in a thread); every step is bounded by HC_TIMEOUT
+        conn = rpyc.connect_stream(rpyc.SocketStream.connect(host, port, timeout=HC_TIMEOUT),
+                                   config={"sync_request_timeout": HC_TIMEOUT})
+        try:
+            reply = conn.root.ready()
+            if not reply["ready"]:
+                raise RuntimeError("; ".join(reply["problems"]))
+        finally:
+            conn.close()
+
+    def probed(self, idx, rtt_ms):
+        old = self.probe_ms[idx]
+        self.probe_ms[idx] = rtt_ms if not old else old * 0.7 + rtt_ms * 0.3
+        # an idle backend gets no traffic samples: keep its EWMA fresh from probes
+        if self.conns[idx] == 0 and time.monotonic() - self.ewma_at[idx] > EWMA_DECAY:
+            self.observe(idx, rtt_ms)
+
+    def observe(self, idx, rtt_ms):
+        # peak-EWMA: jump straight up to a slower sample, decay down over EWMA_DECAY
+        now = time.monotonic()
+        if rtt_ms >= self.ewma[idx]:
+            self.ewma[idx] = rtt_ms
+        else:
+            w = math.exp(-(now - self.ewma_at[idx]) / EWMA_DECAY)
+            self.ewma[idx] = self.ewma[idx] * w + rtt_ms * (1.0 - w)
+        self.ewma_at[idx] = now
+
+    def recovered(self, idx):
+        self.up_since[idx] = time.monotonic()
+        # no trustworthy latency yet: assume the slowest peer's until it reports
+        self.ewma[idx] = max(self.ewma)
+        self.ewma_at[idx] = self.up_since[idx]
+
+    def latency(self, idx):
+        # decays while no samples arrive, so an avoided backend gets retried
+        return self.ewma[idx] * math.exp(-(time.monotonic() - self.ewma_at[idx]) / EWMA_DECAY)
+
+    def cost(self, idx):
+        c = (self.latency(idx) + 1e-3) * (self.conns[idx] + 1)
+        if SLOW_START > 0:
+            ramp = (time.monotonic() - self.up_since[idx]) / SLOW_START
+            if ramp < 1.0:
+                c /= max(ramp, 0.05)
+        return c
+
+    def live(self, idx):
+        return idx not in self.retired and self.health[idx] and not self.outliers.ejected(idx)
+
+    def available(self, idx):
+        return self.live(idx) and self.admission.has_room(idx)
+
+    def _p2c(self, exclude):
+        # power of two choices: two random backends, keep the cheaper one
+        n = len(self.backends)
+        if not n:
+            return None
+        ok = lambda i: self.available(i) and i not in exclude
+        for _ in range(4):
+            a, b = random.sample(range(n), 2) if n > 1 else (0, 0)
+            cands = [i for i in (a, b) if ok(i)]
+            if cands:
+                return min(cands, key=self.cost)
+        cands = [i for i in range(n) if ok(i)]
+        return min(cands, key=self.cost) if cands else None
+
+    def pick(self, key=None, exclude=(), hedge=False):
+        if ALGO == "hash" and key is not None:
+            ok = lambda i: self.available(i) and i not in exclude
+            if hedge:
+                # a hedge duplicates a request that is slow on the key's owner:
+                # send it to the next owner clockwise, or the owner if it is alone
+                owner = self.ring.lookup(key, self.available)
+                idx = self.ring.lookup(key, lambda i: ok(i) and i != owner)
+                if idx is not None:
+                    return idx
+            return self.ring.lookup(key, ok)
+        if ALGO == "ewma":
+            return self._p2c(exclude)
+
+        healthy_idxs = [i for i in range(len(self.backends)) if self.available(i)]
+        if not healthy_idxs:
+            return None
+
+        if ALGO == "lc":
+            return min(healthy_idxs, key=lambda i: self.conns[i])
+
+        # round-robin over healthy
+        for _ in range(len(self.backends)):
+            idx = next(self._rr)
+            if self.available(idx):
+                return idx
+        return None
+
+
+class LatencyWindow:
+    """Last N samples (ms) for a periodic percentile printout."""
+
+    def __init__(self, size=2000):
+        self.samples = deque(maxlen=size)
+
+    def add(self, ms):
+        self.samples.append(ms)
+
+    def summary(self):
+        if not self.samples:
+            return "n=0"
+        xs = sorted(self.samples)
+        pct = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))]
+        return f"n={len(xs)} p50={pct(0.5):.2f}ms p90={pct(0.9):.2f}ms p99={pct(0.99):.2f}ms"
+
+
+def gauges(pool):
+    # sampled at scrape time; counters and histograms are recorded inline
+    for i, (host, _) in enumerate(pool.backends):
+        if i in pool.retired and not pool.conns[i]:
+            continue
+        b = {"backend": host}
+        yield "lb_inflight_connections", b, pool.conns[i]
+        yield "lb_backend_up", b, int(pool.live(i))
+        yield "lb_backend_latency_ewma_seconds", b, pool.latency(i) / 1000.0
+        yield "lb_admission_limit", b, int(pool.admission.limit[i])
+    yield "lb_admission_queue_depth", {}, len(pool.admission.waiters)
+
+
+async def outlier_loop(pool):
+    while True:
+        await asyncio.sleep(OUTLIER_INTERVAL)
+        pool.outliers.sweep()
+
+
+async def health_loop(pool):
+    health, fails, passes = pool.health, pool.fails, pool.passes
+
+    async def probe_loop(idx, h, p):
+        # one loop per backend, jittered, so probes from several LBs don't line up
+        await asyncio.sleep(random.uniform(0, HC_INTERVAL))
+        while True:
+            try:
+                rtt = await asyncio.wait_for(pool.probe(h, p), timeout=HC_TIMEOUT)
+                pool.probed(idx, rtt)
+                passes[idx] += 1
+                fails[idx] = 0
+                if not health[idx] and passes[idx] >= HC_RISE:
+                    health[idx] = True
+                    pool.recovered(idx)
+                    print(f"{h} is back online")
+            except Exception as e:
+                fails[idx] += 1
+                passes[idx] = 0
+                if health[idx] and fails[idx] >= HC_FALL:
+                    health[idx] = False
+                    print(f"{h} is offline ({type(e).__name__}: {e})")
+            await asyncio.sleep(HC_INTERVAL * random.uniform(1 - HC_JITTER, 1 + HC_JITTER))
+
+    probers = {}   # slot -> (address, task); follows registry joins and leaves
+    while True:
+        for i, addr in enumerate(pool.backends):
+            if i in pool.retired:
+                if i in probers:
+                    probers.pop(i)[1].cancel()
+            elif i not in probers or probers[i][0] != addr:
+                if i in probers:
+                    probers[i][1].cancel()
+                probers[i] = (addr, asyncio.create_task(probe_loop(i, *addr)))
+        pool.changed.clear()
+        await pool.changed.wait()
+
+
+async def registry_loop(pool, r, prober=True):
+    # one reader per LB process; slots are stable, so every worker agrees on indexes
+    initial = True
+    empty = False
+    refill_until = 0.0
+    while True:
+        try:
+            async with r.pipeline(transaction=False) as pipe:
+                pipe.zrangebyscore(REGISTRY_KEY, time.time() - REGISTRY_TTL, "+inf")
+                pipe.hgetall(REGISTRY_ADDR_KEY)
+                pipe.hgetall(REGISTRY_SLOT_KEY)
+                names, addrs, slots = await pipe.execute()
+            members = {}
+            for name in names:
+                if name in addrs and name in slots:
+                    host, _, port = addrs[name].rpartition(":")
+                    members[int(slots[name])] = (host, int(port))
+            if not members and len(pool.retired) < len(pool.backends):
+                # an empty registry is a flushed or evicted one far more often than
+                # every server leaving at once: keep the last known set (health
+                # checks still take dead ones out) until the heartbeats re-register
+                if not empty:
+                    print(f"{pool.tag} registry is empty, keeping the last known backends", flush=True)
+                empty = True
+            else:
+                if empty:
+                    # servers re-register one heartbeat at a time: only add for a TTL
+                    refill_until = time.time() + REGISTRY_TTL
+                empty = False
+                if time.time() < refill_until:
+                    members = {**{i: b for i, b in enumerate(pool.backends) if i not in pool.retired},
+                               **members}
+                pool.sync(members, initial, prober)
+                initial = False
+        except redis.RedisError as e:
+            # keep routing to the last known set until Redis is back
+            print(f"{pool.tag} registry read failed: {e}", flush=True)
+        await asyncio.sleep(REGISTRY_POLL)
+
+
+def binary_route_key(body: bytes):
+    # (file, keyword) of a binary-protocol COUNT frame: u32 id | u8 op | str | str
+    try:
+        if body[4] != 2:
+            return None
+        (n,) = struct.unpack_from(">H", body, 5)
+        fname = body[7:7 + n].decode()
+        (m,) = struct.unpack_from(">H", body, 7 + n)
+        kw = body[9 + n:9 + n + m].decode()
+        return f"{fname}:{kw.lower()}"
+    except (IndexError, struct.error, UnicodeDecodeError):
+        return None
+
+
+async def peek_preface(reader, binary):
+    """Read the client's hint lines and, for ALGO=hash, enough of its opening
+    bytes to route it.
+
+    Returns (route key or None, trace id or None, whether the client marked
+    itself a hedge, bytes that must be forwarded to the backend first). A TRACE
+    line (TRACING=1), a HEDGE line and, for rpyc/JSON clients, a ROUTE hint
+    line are consumed here. Binary clients are routed by their first COUNT frame.
+    """
+    key = trace = None
+    hedge = False
+    taken = b""   # client bytes read here that still belong to the backend
+    try:
+        while True:
+            taken = await asyncio.wait_for(reader.readexactly(len(ROUTE_PREFIX)), HASH_PEEK_TIMEOUT)
+            if taken not in (ROUTE_PREFIX, HEDGE_PREFIX, tracing.TRACE_PREFIX):
+                break
+            line = await asyncio.wait_for(reader.readuntil(b"\n"), HASH_PEEK_TIMEOUT)
+            if taken == ROUTE_PREFIX:
+                key = line.strip().decode(errors="ignore").lower()
+            elif taken == HEDGE_PREFIX:
+                hedge = True
+            else:
+                trace = line.strip().decode(errors="ignore")[:64]
+            taken = b""
+        if binary and ALGO == "hash":
+            (n,) = struct.unpack_from(">I", taken)
+            if 2 <= n <= 65536:
+                taken += await asyncio.wait_for(reader.readexactly(n - 2), HASH_PEEK_TIMEOUT)
+                key = binary_route_key(taken[4:])
+        return key, trace, hedge, taken
+    except asyncio.IncompleteReadError as e:
+        return key, trace, hedge, taken + e.partial
+    except (asyncio.TimeoutError, asyncio.LimitOverrunError):
+        # a timed-out read consumes nothing: the buffered bytes are forwarded as usual
+        return key, trace, hedge, taken
+
+
+async def refuse(writer):
+    # fail fast: no backend is up, or none can take the connection in time
+    with contextlib.suppress(Exception):
+        writer.write(b"Service unavailable")
+        await writer.drain()
+        writer.close()
@@ -0,0 +1,110 @@
+"""Throughput and CPU cost of load_balancer_FD.py per configuration.
+
+Each argument is WORKERS[:PROXY_MODE]. For each one the LB is started on side
+ports, driven by CLIENT_PROCS processes x CONNS connections that each keep
+PIPELINE binary COUNT requests in flight, and the run prints requests/s,
+proxied bytes/s, LB CPU time per request and latency percentiles.
+Run it where the LB can reach server1-3, e.g.
+
+    docker compose exec lb python bench_lb.py 1 2 4              # worker scaling
+    docker compose exec lb python bench_lb.py 1:stream 1:buffered  # pump vs relay
+"""
+import os, sys, time, socket, struct, resource, subprocess, multiprocessing
+
+LB_PORT = int(os.getenv("BENCH_LB_PORT", "9100"))
+BINARY_PORT = int(os.getenv("BENCH_BINARY_PORT", "9101"))
+CLIENT_PROCS = int(os.getenv("CLIENT_PROCS", str(os.cpu_count() or 1)))  # load generator processes
+CONNS = int(os.getenv("CONNS", "8"))                                     # connections per process
+DURATION = float(os.getenv("DURATION", "10"))                            # seconds per run
+PIPELINE = int(os.getenv("PIPELINE", "1"))                               # requests in flight per connection
+FILE, KEYWORD = os.getenv("BENCH_FILE", "grail"), os.getenv("BENCH_KEYWORD", "king")
+
+def count_frame(rid: int) -> bytes:
+    args = b"".join(struct.pack(">H", len(v)) + v for v in (FILE.encode(), KEYWORD.encode()))
+    body = struct.pack(">IB", rid, 2) + args
+    return struct.pack(">I", len(body)) + body
+
+def recv_exact(sock, n):
+    buf = b""
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("closed")
+        buf += chunk
+    return buf
+
+def client(deadline, out):
+    import selectors
+    sel = selectors.DefaultSelector()
+    lat, errors, nbytes = [], 0, 0
+    frame = count_frame(0)
+    for _ in range(CONNS):
+        s = socket.create_connection(("127.0.0.1", BINARY_PORT))
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.sendall(frame * PIPELINE)
+        nbytes += len(frame) * PIPELINE
+        sel.register(s, selectors.EVENT_READ, time.perf_counter())
+    while time.time() < deadline:
+        for key, _ in sel.select(timeout=1.0):
+            s = key.fileobj
+            try:
+                for _ in range(PIPELINE):
+                    (n,) = struct.unpack(">I", recv_exact(s, 4))
+                    if recv_exact(s, n)[4] != 0:
+                        errors += 1
+                    nbytes += 4 + n
+            except ConnectionError:
+                errors += 1
+                sel.unregister(s)
+                continue
+            now = time.perf_counter()
+            lat.append((now - key.data) * 1000.0)
+            s.sendall(frame * PIPELINE)
+            nbytes += len(frame) * PIPELINE
+            sel.modify(s, selectors.EVENT_READ, now)
+    out.put((lat, errors, nbytes))
+
+def lb_cpu():
+    # CPU of waited-for children; the LB is the only one reaped inside the window
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime
+
+def run(spec: str):
+    workers, _, mode = spec.partition(":")
+    env = dict(os.environ, LB_WORKERS=workers, LB_PORT=str(LB_PORT),
+               LB_BINARY_PORT=str(BINARY_PORT), STATS_INTERVAL="0", METRICS_PORT="0")
+    if mode:
+        env["PROXY_MODE"] = mode
+    here = os.path.dirname(os.path.abspath(__file__))
+    lb = subprocess.Popen([sys.executable, os.path.join(here, "load_balancer_FD.py")], env=env,
+                          stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(2)   # listeners up, connection pools filled
+        out = multiprocessing.Queue()
+        deadline = time.time() + DURATION
+        procs = [multiprocessing.Process(target=client, args=(deadline, out)) for _ in range(CLIENT_PROCS)]
+        for p in procs:
+            p.start()
+        results = [out.get() for _ in procs]
+        for p in procs:
+            p.join()
+    finally:
+        cpu = lb_cpu()
+        lb.terminate()
+        lb.wait()
+    cpu = lb_cpu() - cpu
+    lat = sorted(x for l, _, _ in results for x in l)
+    errors = sum(e for _, e, _ in results)
+    nbytes = sum(b for _, _, b in results)
+    reqs = len(lat) * PIPELINE
+    pct = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] if lat else float("nan")
+    print(f"{spec:<12} req/s={reqs / DURATION:>9.0f}  MB/s={nbytes / DURATION / 1e6:6.2f}  "
+          f"cpu/req={cpu / max(reqs, 1) * 1e6:6.1f}us  p50={pct(0.5):6.2f}ms  "
+          f"p99={pct(0.99):6.2f}ms  errors={errors}", flush=True)
+
+if __name__ == "__main__":
+    print(f"{CLIENT_PROCS} client process(es) x {CONNS} connection(s) x {PIPELINE} in flight, "
+          f"{DURATION:.0f}s per run")
+    for spec in sys.argv[1:] or ["1", "2", "4"]:
+        run(spec)
+        time.sleep(1)
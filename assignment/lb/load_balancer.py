@@ -3,6 +3,8 @@ import asyncio
 import itertools
 import contextlib
 
+import relay
+
 BACKENDS = [ ("server1", 18861),
     ("server2", 18861),
     ("server3", 18861),
@@ -10,6 +12,7 @@ BACKENDS = [ ("server1", 18861),
 
 ALGO = os.getenv("ALGO", "rr").lower()   # 'rr' or 'lc'
 LISTEN_PORT = int(os.getenv("LB_PORT", "9000"))
+PROXY_MODE = os.getenv("PROXY_MODE", "buffered")  # 'stream' (read/write pump) or 'buffered' (relay.py)
 
 class Pool:
     def __init__(self, backends):
@@ -43,7 +46,10 @@ async def proxy_client(reader, writer):
                 with contextlib.suppress(Exception):
                     dst.close()
 
-        await asyncio.gather(pump(reader, backend_writer), pump(backend_reader, writer))
+        if PROXY_MODE == "buffered":
+            await relay.relay(reader, writer, backend_reader, backend_writer)
+        else:
+            await asyncio.gather(pump(reader, backend_writer), pump(backend_reader, writer))
     except Exception:
         with contextlib.suppress(Exception):
             writer.close()
@@ -1,145 +1,260 @@
 import os
 import asyncio
-import itertools
-import contextlib
+import multiprocessing.connection
+import signal
+import functools
+import time
 
-BACKENDS = [("server1", 18861), ("server2", 18861), ("server3", 18861)]
+import redis.asyncio as aioredis
 
-health = {b[0]: True  for b in BACKENDS}
-fails  = {b[0]: 0     for b in BACKENDS}
-passes = {b[0]: 0     for b in BACKENDS}
+import balancer
+import metrics
+import relay
+import tracing
+from balancer import ALGO, ADMIT_DEADLINE, BACKENDS, BINARY_BACKEND_PORT, CAPACITY, REGISTRY
 
-HC_INTERVAL = float(os.getenv("HC_INTERVAL", "2"))  # seconds between checks
-HC_TIMEOUT = float(os.getenv("HC_TIMEOUT", "1"))  # TCP dial timeout
-HC_FALL = int(os.getenv("HC_FALL", "2"))  # mark DOWN after N fails
-HC_RISE = int(os.getenv("HC_RISE", "2"))
-
-ALGO = os.getenv("ALGO", "rr").lower()  # 'rr' or 'lc'
 LISTEN_PORT = int(os.getenv("LB_PORT", "9000"))
+LB_WORKERS = int(os.getenv("LB_WORKERS", "1"))  # >1: fork this many SO_REUSEPORT worker processes
+PROXY_MODE = os.getenv("PROXY_MODE", "buffered")  # stream = read/write/drain pump; buffered = BufferedProtocol relay (relay.py)
 EXTRA_INFO = bool(int(os.getenv("EXTRA_INFO", "0")))
+BINARY_LISTEN_PORT = int(os.getenv("LB_BINARY_PORT", "9001"))         # binary protocol listener; 0 = off
 
+BACKEND_POOL_SIZE = int(os.getenv("BACKEND_POOL_SIZE", "4"))        # pre-dialed idle connections per backend port; 0 = off
+POOL_IDLE_TIMEOUT = float(os.getenv("POOL_IDLE_TIMEOUT", "30"))    # close pooled connections idle longer than this
+STATS_INTERVAL = float(os.getenv("STATS_INTERVAL", "30"))          # print accept->first byte latency every N s; 0 = off
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9102"))               # Prometheus text on HTTP; worker N serves port + N; 0 = off
+TRACING = bool(int(os.getenv("TRACING", "0")))                      # strip clients' TRACE lines and record LB spans (tracing.py)
+BACKEND_CONNECT_TIMEOUT = float(os.getenv("BACKEND_CONNECT_TIMEOUT", "1"))  # dial timeout for proxied connections
+REDIS_HOST = os.getenv("REDIS_HOST", "redis")
+REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
+REDIS_DB = int(os.getenv("REDIS_DB", "0"))
 
 
+_mp = multiprocessing.get_context("fork")
 
-class Pool:
-    def __init__(self, backends):
-        self.backends = backends
-        self._rr = itertools.cycle(range(len(backends)))
-        self.conns = [0] * len(backends)
 
-    async def tcp_check(self, host, port):
-        try:
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(host, port),
-                timeout=HC_TIMEOUT
-            )
-            writer.close()
-            await writer.wait_closed()
-            return True
-        except Exception:
-            return False
+class SharedTable:
+    """One number per backend slot in shared memory (balancer.Table's interface).
+
+    Created before the workers fork, so every worker sees the same health
+    state and connection counts. Sized for CAPACITY backends, so registry
+    additions fit without reallocating. Use add() for read-modify-write updates.
+    """
+
+    def __init__(self, initial, typecode="q"):
+        self._arr = _mp.Array(typecode, [initial] * CAPACITY)
 
-    def pick(self):
-        healthy_idxs = [i for i, (h, _) in enumerate(self.backends) if health[h]]
-        if not healthy_idxs:
-            return None
+    def __getitem__(self, idx):
+        return self._arr[idx]
 
-        if ALGO == "lc":
-            return min(healthy_idxs, key=lambda i: self.conns[i])
+    def __setitem__(self, idx, value):
+        self._arr[idx] = value
 
-        # round-robin over healthy
-        for _ in range(len(self.backends)):
-            idx = next(self._rr)
-            if health[self.backends[idx][0]]:
-                return idx
-        return None
+    def __len__(self):
+        return len(self._arr)
 
+    def add(self, idx, delta):
+        with self._arr.get_lock():
+            self._arr[idx] += delta
 
-pool = Pool(BACKENDS)
 
+conn_pool = balancer.BackendConnPool(BACKEND_POOL_SIZE, POOL_IDLE_TIMEOUT)
+pool = balancer.Pool(BACKENDS, conn_pool, table=SharedTable)
+outliers, admission = pool.outliers, pool.admission
+ttfb = balancer.LatencyWindow()   # client accept -> first backend byte written back
+lb_metrics = metrics.Metrics()
+spans = tracing.Spans()
 
-async def health_loop():
+
+async def stats_loop(worker=0):
+    tag = f"[LB {worker + 1}/{LB_WORKERS}]" if LB_WORKERS > 1 else "[LB]"
     while True:
-        checks = []
-        for host, port in BACKENDS:
-            async def probe(h=host, p=port):
-                try:
-                    fut = asyncio.open_connection(h, p)
-                    r, w = await asyncio.wait_for(fut, timeout=HC_TIMEOUT)
-                    w.close()
-                    with contextlib.suppress(Exception):
-                        await w.wait_closed()
-                    passes[h] += 1
-                    fails[h] = 0
-                    if not health[h] and passes[h] >= HC_RISE:
-                        health[h] = True
-                        print(f"{h} is back online")
-                except Exception:
-                    fails[h] += 1
-                    passes[h] = 0
-                    if health[h] and fails[h] >= HC_FALL:
-                        health[h] = False
-                        print(f"{h} is offline")
-            checks.append(asyncio.create_task(probe()))
-        # let all probes finish; then sleep
-        with contextlib.suppress(Exception):
-            await asyncio.gather(*checks)
-        await asyncio.sleep(HC_INTERVAL)
-
-async def proxy_client(reader, writer):
+        await asyncio.sleep(STATS_INTERVAL)
+        live = [i for i in range(len(pool.backends)) if i not in pool.retired]
+        probes = " ".join(f"{pool.backends[i][0]}={pool.probe_ms[i]:.1f}ms" for i in live)
+        print(f"{tag} accept->first byte {ttfb.summary()}  "
+              f"pool hits={conn_pool.hits} misses={conn_pool.misses}  probe rtt {probes}  "
+              f"limits={[int(admission.limit[i]) for i in live]} queued={len(admission.waiters)} shed={admission.shed}",
+              flush=True)
+
+
+async def proxy_client(reader, writer, backend_port=None):
+    accepted = time.perf_counter()
     tried = set()
+    key, trace, hedge, prefix = None, None, False, b""
+    if ALGO == "hash" or TRACING:
+        key, trace, hedge, prefix = await balancer.peek_preface(reader, binary=backend_port is not None)
+        if trace:
+            spans.add(trace, "lb.preface", accepted, time.perf_counter(), hedge=hedge)
     while True:
         if EXTRA_INFO:
             print(f"[LB] New connection from client {writer.get_extra_info('peername')}")
-        idx = pool.pick()
-        host, port = pool.backends[idx]
-        if EXTRA_INFO:
-            print(f"[LB] Connecting client -> {host}:{port}")
+        queued_at = time.perf_counter()   # after the preface: admission wait only
+        admitted = await admission.admit(tried, accepted + ADMIT_DEADLINE)
+        if trace:
+            spans.add(trace, "lb.queue", queued_at, time.perf_counter(), attempt=len(tried) + 1, shed=not admitted)
+        if not admitted:
+            lb_metrics.inc("lb_shed_total", reason="admission")
+            await balancer.refuse(writer)
+            return
+        idx = pool.pick(key, exclude=tried, hedge=hedge)
 
         if idx is None or idx in tried:
-            with contextlib.suppress(Exception):
-                # No one is healthy
-                writer.write(b"Service unavailable")
-                await writer.drain()
-                writer.close()
+            # No one is healthy
+            lb_metrics.inc("lb_shed_total", reason="no_backend")
+            await balancer.refuse(writer)
             return
+        if tried:
+            lb_metrics.inc("lb_retries_total")
 
+        host, port = pool.backends[idx]
+        port = backend_port or port
+        if EXTRA_INFO:
+            print(f"[LB] Connecting client -> {host}:{port} key={key}")
         tried.add(idx)
-        if not health[host]:
+        if not pool.health[idx]:
             continue
+        conns_incremented = False
+        nbytes = [0, 0]   # down, up
         try:
-            backend_reader, backend_writer = await asyncio.open_connection(host, port)
+            dial_at = time.perf_counter()
+            try:
+                if BACKEND_POOL_SIZE > 0:
+                    dial = conn_pool.acquire(host, port)
+                else:
+                    dial = asyncio.open_connection(host, port)
+                backend_reader, backend_writer = await asyncio.wait_for(dial, BACKEND_CONNECT_TIMEOUT)
+            except Exception as e:
+                timeout = isinstance(e, asyncio.TimeoutError)
+                outliers.failure(idx, "connect timeout" if timeout else "connect error")
+                lb_metrics.inc("lb_connect_failures_total", backend=host, reason="timeout" if timeout else "error")
+                if trace:
+                    spans.add(trace, "lb.connect", dial_at, time.perf_counter(), backend=host,
+                              error="timeout" if timeout else type(e).__name__)
+                raise
             if EXTRA_INFO:
                 print(f"[LB] Connection established: {host}:{port}")
-            pool.conns[idx] += 1
-
-            async def pump(src, dst):
-                try:
-                    while True:
-                        data = await src.read(65536)
-                        if not data:
-                            break
-                        dst.write(data)
-                        await dst.drain()
-                finally:
-                    with contextlib.suppress(Exception):
-                        dst.close()
-
-            await asyncio.gather(pump(reader, backend_writer), pump(backend_reader, writer))
+            pool.conns.add(idx, 1)
+            conns_incremented = True
+            connected_at = time.perf_counter()
+            if trace:
+                spans.add(trace, "lb.connect", dial_at, connected_at, backend=host)
+            lb_metrics.inc("lb_connections_total", backend=host)
+            lb_metrics.histogram("lb_connect_seconds", backend=host).observe(time.perf_counter() - dial_at)
+            request_seconds = lb_metrics.histogram("lb_request_seconds", backend=host)
+            sent_at = None   # first unanswered upstream write, for the EWMA
+            client_done = answered = dropped = False
+            if prefix:
+                backend_writer.write(prefix)
+                sent_at = time.perf_counter()
+
+            def chunk(upstream, n):
+                nonlocal sent_at, answered
+                now = time.perf_counter()
+                nbytes[upstream] += n
+                if upstream:
+                    sent_at = sent_at or now
+                    return
+                if not answered:
+                    ttfb.add((now - accepted) * 1000.0)
+                    lb_metrics.histogram("lb_first_byte_seconds", backend=host).observe(now - accepted)
+                    answered = True
+                if sent_at is not None:
+                    request_seconds.observe(now - sent_at)
+                    pool.observe(idx, (now - sent_at) * 1000.0)
+                    admission.sample(idx, (now - sent_at) * 1000.0)
+                    outliers.sample(idx, (now - sent_at) * 1000.0)
+                    sent_at = None
+
+            def eof(upstream):
+                nonlocal client_done, dropped
+                if upstream:
+                    client_done = True
+                elif sent_at is not None and not answered and not client_done:
+                    # hung up before answering anything; a later EOF may be
+                    # the reply to a protocol-level close (rpyc does this)
+                    dropped = True
+
+            forward = relay.relay if PROXY_MODE == "buffered" else relay.pump
+            try:
+                await forward(reader, writer, backend_reader, backend_writer, chunk, eof)
+            except relay.RelayError as e:
+                if not e.backend:
+                    break   # the client reset: not the backend's fault, and nobody to retry for
+                outliers.failure(idx, "connection reset")
+                raise
+            if dropped:
+                outliers.failure(idx, "dropped mid-request")
+            else:
+                outliers.success(idx)
             break
 
         except Exception:
             continue
         finally:
-            pool.conns[idx] -= 1
+            if conns_incremented:
+                pool.conns.add(idx, -1)
+                admission.release()
+                lb_metrics.inc("lb_bytes_total", nbytes[1], backend=host, direction="up")
+                lb_metrics.inc("lb_bytes_total", nbytes[0], backend=host, direction="down")
+                if trace:
+                    spans.add(trace, "lb.proxy", connected_at, time.perf_counter(), backend=host,
+                              bytes_up=nbytes[1], bytes_down=nbytes[0])
 
 
-async def main():
-    server = await asyncio.start_server(proxy_client, host="0.0.0.0", port=LISTEN_PORT)
-    print(f"Load balancer with failure detection listening on :{LISTEN_PORT}  ALGO={ALGO}")
+async def main(worker=0):
+    # reuse_port lets every worker bind the same listeners; the kernel spreads accepts
+    reuse = LB_WORKERS > 1
+    server = await asyncio.start_server(proxy_client, host="0.0.0.0", port=LISTEN_PORT,
+                                        reuse_port=reuse)
+    print(f"Load balancer with failure detection listening on :{LISTEN_PORT}  ALGO={ALGO}"
+          + (f"  worker {worker + 1}/{LB_WORKERS}" if reuse else ""))
+    if REGISTRY:
+        # one reader per worker; slots are stable, so every worker agrees on indexes
+        asyncio.create_task(balancer.registry_loop(pool, aioredis.Redis(
+            host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True,
+            socket_timeout=2, socket_connect_timeout=2), prober=worker == 0))
+    if worker == 0:
+        # one prober for all workers: the results land in the shared tables
+        asyncio.create_task(balancer.health_loop(pool))
+    asyncio.create_task(balancer.outlier_loop(pool))
+    if BACKEND_POOL_SIZE > 0:
+        asyncio.create_task(conn_pool.refill_loop(
+            pool, lambda port: [port] + ([BINARY_BACKEND_PORT] if BINARY_LISTEN_PORT else [])))
+    if STATS_INTERVAL > 0:
+        asyncio.create_task(stats_loop(worker))
+    if TRACING:
+        asyncio.create_task(spans.flush_loop(aioredis.Redis(
+            host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, socket_timeout=2, socket_connect_timeout=2)))
+    if METRICS_PORT:
+        # per worker: each one's counters are its own, so each gets its own scrape target
+        asyncio.create_task(metrics.serve(METRICS_PORT + worker, lambda: lb_metrics.render(balancer.gauges(pool))))
+    if BINARY_LISTEN_PORT:
+        # same pool and health state, forwarded to the servers' binary listener
+        binary = await asyncio.start_server(
+            functools.partial(proxy_client, backend_port=BINARY_BACKEND_PORT),
+            host="0.0.0.0", port=BINARY_LISTEN_PORT, reuse_port=reuse)
+        if worker == 0:
+            print(f"Binary protocol listening on :{BINARY_LISTEN_PORT} -> backend port {BINARY_BACKEND_PORT}")
+        asyncio.create_task(binary.serve_forever())
     async with server:
         await server.serve_forever()
 
 
+def run_workers(n):
+    procs = [_mp.Process(target=lambda i=i: asyncio.run(main(i)), daemon=True) for i in range(n)]
+    for p in procs:
+        p.start()
+    signal.signal(signal.SIGTERM, lambda *_: [p.terminate() for p in procs])
+    # if any worker dies, take the rest down so the container restarts cleanly
+    multiprocessing.connection.wait([p.sentinel for p in procs])
+    for p in procs:
+        p.terminate()
+        p.join()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if LB_WORKERS > 1:
+        run_workers(LB_WORKERS)
+    else:
+        asyncio.run(main())
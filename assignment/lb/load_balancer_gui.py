@@ -1,15 +1,22 @@
-import os, asyncio, itertools, contextlib, time, json, secrets, redis
+import os, asyncio, functools, time, json, secrets
+import redis.asyncio as aioredis
+import balancer
+import metrics
+import relay
+import tracing
+from balancer import ALGO, ADMIT_DEADLINE, BACKENDS, BINARY_BACKEND_PORT, REGISTRY
 
-BACKENDS = [("server1", 18861), ("server2", 18861), ("server3", 18861)]
-
-HC_INTERVAL = float(os.getenv("HC_INTERVAL", "2"))   # seconds between checks
-HC_TIMEOUT  = float(os.getenv("HC_TIMEOUT", "1"))    # TCP dial timeout
-HC_FALL     = int(os.getenv("HC_FALL", "2"))         # mark DOWN after N fails
-HC_RISE     = int(os.getenv("HC_RISE", "2"))         # mark UP after N passes
-
-ALGO        = os.getenv("ALGO", "rr").lower()        # 'rr' or 'lc'
 LISTEN_PORT = int(os.getenv("LB_PORT", "9000"))
 EXTRA_INFO  = bool(int(os.getenv("EXTRA_INFO", "0")))
+PROXY_MODE  = os.getenv("PROXY_MODE", "buffered")    # stream = read/write/drain pump; buffered = BufferedProtocol relay (relay.py)
+BINARY_LISTEN_PORT  = int(os.getenv("LB_BINARY_PORT", "9001"))        # binary protocol listener; 0 = off
+
+BACKEND_POOL_SIZE = int(os.getenv("BACKEND_POOL_SIZE", "4"))        # pre-dialed idle connections per backend port; 0 = off
+POOL_IDLE_TIMEOUT = float(os.getenv("POOL_IDLE_TIMEOUT", "30"))    # close pooled connections idle longer than this
+STATS_INTERVAL = float(os.getenv("STATS_INTERVAL", "30"))          # print accept->first byte latency every N s; 0 = off
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9102"))               # Prometheus text on HTTP; 0 = off
+TRACING = bool(int(os.getenv("TRACING", "0")))                      # strip clients' TRACE lines and record LB spans (tracing.py)
+BACKEND_CONNECT_TIMEOUT = float(os.getenv("BACKEND_CONNECT_TIMEOUT", "1"))  # dial timeout for proxied connections
 
 # Redis (for dashboard)
 REDIS_HOST  = os.getenv("REDIS_HOST", "redis")
@@ -18,72 +25,72 @@ REDIS_DB    = int(os.getenv("REDIS_DB", "0"))
 
 EVENTS_STREAM = "lb:events"   # Redis Stream for events
 SNAPSHOT_KEY  = "lb:snapshot" # Redis Hash for periodic snapshot
+EVENTS_MAXLEN = 2000          # approximate stream length kept
+TELEMETRY_QUEUE = int(os.getenv("TELEMETRY_QUEUE", "10000"))  # buffered events; new ones are dropped beyond this
+TELEMETRY_BATCH = int(os.getenv("TELEMETRY_BATCH", "200"))    # XADDs per pipeline round trip
 
 client_ids = {}
 
-r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
-health = {b[0]: True  for b in BACKENDS}
-fails  = {b[0]: 0     for b in BACKENDS}
-passes = {b[0]: 0     for b in BACKENDS}
+r = aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True,
+                   socket_timeout=2, socket_connect_timeout=2)
+
+def announce(event, host, port, conns):
+    # registry joins and leaves, for the dashboard log
+    fields = {"type": f"backend_{event}", "ts": time.time(), "backend": host, "port": port}
+    if event == "leave":
+        fields["draining"] = conns
+    telemetry.emit(fields)
+
+conn_pool = balancer.BackendConnPool(BACKEND_POOL_SIZE, POOL_IDLE_TIMEOUT)
+pool = balancer.Pool(BACKENDS, conn_pool, tag="[GUI LB]", on_member=announce)
+outliers, admission = pool.outliers, pool.admission
+ttfb = balancer.LatencyWindow()   # client accept -> first backend byte written back
+lb_metrics = metrics.Metrics()
+spans = tracing.Spans()
+
+class Telemetry:
+    """Dashboard events, queued in memory and written to Redis by flush_loop.
 
-class Pool:
-    def __init__(self, backends):
-        self.backends = backends
-        self._rr = itertools.cycle(range(len(backends)))
-        self.conns = [0] * len(backends)
+    emit() never waits: with the queue full the event is dropped and counted,
+    so a slow or unreachable Redis can't stall proxied traffic.
+    """
 
-    async def tcp_check(self, host, port):
+    def __init__(self, size):
+        self.queue = asyncio.Queue(maxsize=size)
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def emit(self, fields):
         try:
-            reader, writer = await asyncio.wait_for(
-                asyncio.open_connection(host, port), timeout=HC_TIMEOUT
-            )
-            writer.close()
-            await writer.wait_closed()
-            return True
-        except Exception:
-            return False
-
-    def pick(self):
-        healthy_idxs = [i for i, (h, _) in enumerate(self.backends) if health[h]]
-        if not healthy_idxs:
-            return None
-        if ALGO == "lc":
-            return min(healthy_idxs, key=lambda i: self.conns[i])
-        # round-robin over healthy
-        for _ in range(len(self.backends)):
-            idx = next(self._rr)
-            if health[self.backends[idx][0]]:
-                return idx
-        return None
-
-pool = Pool(BACKENDS)
-
-async def health_loop():
+            self.queue.put_nowait(fields)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def flush_loop(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < TELEMETRY_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                async with r.pipeline(transaction=False) as pipe:
+                    for fields in batch:
+                        pipe.xadd(EVENTS_STREAM, fields, maxlen=EVENTS_MAXLEN, approximate=True)
+                    await pipe.execute()
+                self.sent += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                self.errors += 1
+                print(f"[GUI LB] telemetry flush failed ({e}); dropped {len(batch)} event(s)")
+                await asyncio.sleep(1.0)   # let Redis recover; meanwhile the queue absorbs or drops
+
+telemetry = Telemetry(TELEMETRY_QUEUE)
+
+async def stats_loop():
     while True:
-        checks = []
-        for host, port in BACKENDS:
-            async def probe(h=host, p=port):
-                try:
-                    fut = asyncio.open_connection(h, p)
-                    rconn, w = await asyncio.wait_for(fut, timeout=HC_TIMEOUT)
-                    w.close()
-                    with contextlib.suppress(Exception):
-                        await w.wait_closed()
-                    passes[h] += 1
-                    fails[h] = 0
-                    if not health[h] and passes[h] >= HC_RISE:
-                        health[h] = True
-                        print(f"{h} is back online")
-                except Exception:
-                    fails[h] += 1
-                    passes[h] = 0
-                    if health[h] and fails[h] >= HC_FALL:
-                        health[h] = False
-                        print(f"{h} is offline")
-            checks.append(asyncio.create_task(probe()))
-        with contextlib.suppress(Exception):
-            await asyncio.gather(*checks)
-        await asyncio.sleep(HC_INTERVAL)
+        await asyncio.sleep(STATS_INTERVAL)
+        print(f"[LB] accept->first byte {ttfb.summary()}  "
+              f"pool hits={conn_pool.hits} misses={conn_pool.misses}", flush=True)
 
 async def snapshot_loop():
     while True:
@@ -93,20 +100,39 @@ async def snapshot_loop():
             "backends": json.dumps([
                 {
                     "name": h, "port": p,
-                    "healthy": bool(health[h]),
-                    "conns": pool.conns[i]
+                    "healthy": bool(pool.health[i]) and i not in pool.retired,
+                    "draining": i in pool.retired,
+                    "conns": pool.conns[i],
+                    "ewma_ms": round(pool.latency(i), 2),
+                    "probe_ms": round(pool.probe_ms[i], 2),
+                    **outliers.describe(i),
+                    **admission.describe(i)
                 }
                 for i, (h, p) in enumerate(pool.backends)
+                if i not in pool.retired or pool.conns[i]
             ])
         }
+        snapshot.update(queue_depth=len(admission.waiters), shed=admission.shed)
+        snapshot.update(events_sent=telemetry.sent, events_dropped=telemetry.dropped,
+                        events_queued=telemetry.queue.qsize())
         # Hash set: overwrite current snapshot atomically
-        r.hset(SNAPSHOT_KEY, mapping=snapshot)
+        try:
+            await r.hset(SNAPSHOT_KEY, mapping=snapshot)
+        except Exception as e:
+            print(f"[GUI LB] snapshot write failed: {e}")
         await asyncio.sleep(1.0)
 
-async def proxy_client(reader, writer):
+async def proxy_client(reader, writer, backend_port=None):
+    accepted = time.perf_counter()
     tried = set()
-    # Per-connection correlation id + client label
-    cid = f"{int(time.time()*1000)}-{secrets.token_hex(3)}"
+    key, trace, hedge, prefix = None, None, False, b""
+    if ALGO == "hash" or TRACING:
+        key, trace, hedge, prefix = await balancer.peek_preface(reader, binary=backend_port is not None)
+        if trace:
+            spans.add(trace, "lb.preface", accepted, time.perf_counter(), hedge=hedge)
+
+    # Per-connection correlation id (the client's trace id when it sent one) + client label
+    cid = trace or f"{int(time.time()*1000)}-{secrets.token_hex(3)}"
     client_peer = str(writer.get_extra_info("peername")[0])
     if client_peer not in client_ids:
         client_ids[client_peer] = len(client_ids) + 1
@@ -116,7 +142,7 @@ async def proxy_client(reader, writer):
         print(f"[LB] New connection from client {client_peer} cid={cid}")
 
     # hop: client -> LB (accept)
-    r.xadd(EVENTS_STREAM, {
+    telemetry.emit({
         "type": "accept",
         "cid": cid,
         "ts": time.time(),
@@ -124,20 +150,37 @@ async def proxy_client(reader, writer):
         "dst": "lb",
         "client_peer": client_peer,
         "algo": ALGO
-    }, maxlen=2000, approximate=True)
+    })
 
     while True:
-        idx = pool.pick()
+        queued_at = time.perf_counter()   # after the preface: admission wait only
+        admitted = await admission.admit(tried, accepted + ADMIT_DEADLINE)
+        if trace:
+            spans.add(trace, "lb.queue", queued_at, time.perf_counter(), attempt=len(tried) + 1, shed=not admitted)
+        if not admitted:
+            telemetry.emit({
+                "type": "shed",
+                "cid": cid,
+                "ts": time.time(),
+                "client_peer": client_peer,
+                "algo": ALGO,
+                "waited_ms": int((time.perf_counter() - accepted) * 1000)
+            })
+            lb_metrics.inc("lb_shed_total", reason="admission")
+            await balancer.refuse(writer)
+            return
+        idx = pool.pick(key, exclude=tried, hedge=hedge)
         if idx is None or idx in tried:
-            with contextlib.suppress(Exception):
-                writer.write(b"Service unavailable")
-                await writer.drain()
-                writer.close()
+            lb_metrics.inc("lb_shed_total", reason="no_backend")
+            await balancer.refuse(writer)
             return
+        if tried:
+            lb_metrics.inc("lb_retries_total")
 
         host, port = pool.backends[idx]
+        port = backend_port or port
         tried.add(idx)
-        if not health[host]:
+        if not pool.health[idx] or idx in pool.retired:
             continue
 
         if EXTRA_INFO:
@@ -146,15 +189,36 @@ async def proxy_client(reader, writer):
         start = time.time()
         bytes_up = 0
         bytes_down = 0
+        first_byte_ms = None
         conns_incremented = False
 
         try:
-            backend_reader, backend_writer = await asyncio.open_connection(host, port)
+            dial_at = time.perf_counter()
+            try:
+                if BACKEND_POOL_SIZE > 0:
+                    dial = conn_pool.acquire(host, port)
+                else:
+                    dial = asyncio.open_connection(host, port)
+                backend_reader, backend_writer = await asyncio.wait_for(dial, BACKEND_CONNECT_TIMEOUT)
+            except Exception as e:
+                timeout = isinstance(e, asyncio.TimeoutError)
+                outliers.failure(idx, "connect timeout" if timeout else "connect error")
+                lb_metrics.inc("lb_connect_failures_total", backend=host, reason="timeout" if timeout else "error")
+                if trace:
+                    spans.add(trace, "lb.connect", dial_at, time.perf_counter(), backend=host,
+                              error="timeout" if timeout else type(e).__name__)
+                raise
             pool.conns[idx] += 1
             conns_incremented = True
+            connected_at = time.perf_counter()
+            if trace:
+                spans.add(trace, "lb.connect", dial_at, connected_at, backend=host)
+            lb_metrics.inc("lb_connections_total", backend=host)
+            lb_metrics.histogram("lb_connect_seconds", backend=host).observe(time.perf_counter() - dial_at)
+            request_seconds = lb_metrics.histogram("lb_request_seconds", backend=host)
 
             # hop: LB -> server (connected OK)
-            r.xadd(EVENTS_STREAM, {
+            telemetry.emit({
                 "type": "connect_ok",
                 "cid": cid,
                 "ts": time.time(),
@@ -164,32 +228,54 @@ async def proxy_client(reader, writer):
                 "backend_port": port,
                 "algo": ALGO,
                 "client_peer": client_peer
-            }, maxlen=2000, approximate=True)
-
-            async def pump(src, dst, direction):
-                nonlocal bytes_up, bytes_down
-                try:
-                    while True:
-                        data = await src.read(65536)
-                        if not data:
-                            break
-                        dst.write(data)
-                        await dst.drain()
-                        n = len(data)
-                        if direction == "up":
-                            bytes_up += n
-                        else:
-                            bytes_down += n
-                finally:
-                    with contextlib.suppress(Exception):
-                        dst.close()
-                        if hasattr(dst, "wait_closed"):
-                            await dst.wait_closed()
-
-            await asyncio.gather(
-                pump(reader, backend_writer, "up"),
-                pump(backend_reader, writer, "down")
-            )
+            })
+
+            sent_at = None   # first unanswered upstream write, for the EWMA
+            client_done = dropped = False
+            if prefix:
+                backend_writer.write(prefix)
+                sent_at = time.perf_counter()
+
+            def chunk(upstream, n):
+                nonlocal bytes_up, bytes_down, first_byte_ms, sent_at
+                now = time.perf_counter()
+                if upstream:
+                    bytes_up += n
+                    sent_at = sent_at or now
+                    return
+                bytes_down += n
+                if first_byte_ms is None:
+                    first_byte_ms = (now - accepted) * 1000.0
+                    ttfb.add(first_byte_ms)
+                    lb_metrics.histogram("lb_first_byte_seconds", backend=host).observe(now - accepted)
+                if sent_at is not None:
+                    request_seconds.observe(now - sent_at)
+                    pool.observe(idx, (now - sent_at) * 1000.0)
+                    admission.sample(idx, (now - sent_at) * 1000.0)
+                    outliers.sample(idx, (now - sent_at) * 1000.0)
+                    sent_at = None
+
+            def eof(upstream):
+                nonlocal client_done, dropped
+                if upstream:
+                    client_done = True
+                elif sent_at is not None and first_byte_ms is None and not client_done:
+                    # hung up before answering anything; a later EOF may be
+                    # the reply to a protocol-level close (rpyc does this)
+                    dropped = True
+
+            forward = relay.relay if PROXY_MODE == "buffered" else relay.pump
+            try:
+                await forward(reader, writer, backend_reader, backend_writer, chunk, eof)
+            except relay.RelayError as e:
+                if not e.backend:
+                    break   # the client reset: not the backend's fault, and nobody to retry for
+                outliers.failure(idx, "connection reset")
+                raise
+            if dropped:
+                outliers.failure(idx, "dropped mid-request")
+            else:
+                outliers.success(idx)
 
             # success: end of this client session; do not try other backends
             break
@@ -203,9 +289,15 @@ async def proxy_client(reader, writer):
         finally:
             if conns_incremented:
                 pool.conns[idx] -= 1
+                admission.release()
+                lb_metrics.inc("lb_bytes_total", bytes_up, backend=host, direction="up")
+                lb_metrics.inc("lb_bytes_total", bytes_down, backend=host, direction="down")
+                if trace:
+                    spans.add(trace, "lb.proxy", connected_at, time.perf_counter(), backend=host,
+                              bytes_up=bytes_up, bytes_down=bytes_down)
 
             # SINGLE end event with metrics (this drives your text log line)
-            r.xadd(EVENTS_STREAM, {
+            telemetry.emit({
                 "type": "end",
                 "cid": cid,
                 "ts": time.time(),
@@ -215,15 +307,36 @@ async def proxy_client(reader, writer):
                 "algo": ALGO,
                 "duration_ms": int((time.time() - start) * 1000),
                 "bytes_up": bytes_up,
-                "bytes_down": bytes_down
-            }, maxlen=2000, approximate=True)
+                "bytes_down": bytes_down,
+                "ttfb_ms": round(first_byte_ms, 2) if first_byte_ms is not None else ""
+            })
 
 async def main():
     server = await asyncio.start_server(proxy_client, host="0.0.0.0", port=LISTEN_PORT)
     print(f"[GUI LB] listening on :{LISTEN_PORT}  ALGO={ALGO}  redis={REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}")
     # Run health checks + snapshots
-    asyncio.create_task(health_loop())
+    if REGISTRY:
+        asyncio.create_task(balancer.registry_loop(pool, r))
+    asyncio.create_task(balancer.health_loop(pool))
     asyncio.create_task(snapshot_loop())
+    asyncio.create_task(telemetry.flush_loop())
+    if TRACING:
+        asyncio.create_task(spans.flush_loop(r))
+    asyncio.create_task(balancer.outlier_loop(pool))
+    if BACKEND_POOL_SIZE > 0:
+        asyncio.create_task(conn_pool.refill_loop(
+            pool, lambda port: [port] + ([BINARY_BACKEND_PORT] if BINARY_LISTEN_PORT else [])))
+    if STATS_INTERVAL > 0:
+        asyncio.create_task(stats_loop())
+    if METRICS_PORT:
+        asyncio.create_task(metrics.serve(METRICS_PORT, lambda: lb_metrics.render(balancer.gauges(pool))))
+    if BINARY_LISTEN_PORT:
+        # same pool and health state, forwarded to the servers' binary listener
+        binary = await asyncio.start_server(
+            functools.partial(proxy_client, backend_port=BINARY_BACKEND_PORT),
+            host="0.0.0.0", port=BINARY_LISTEN_PORT)
+        print(f"[GUI LB] binary protocol on :{BINARY_LISTEN_PORT} -> backend port {BINARY_BACKEND_PORT}")
+        asyncio.create_task(binary.serve_forever())
     async with server:
         await server.serve_forever()
 
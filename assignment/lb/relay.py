@@ -0,0 +1,138 @@
+"""Protocol-level forwarding between two asyncio streams (PROXY_MODE=buffered).
+
+The stream pump reads every chunk into a fresh bytes object and awaits
+drain() per chunk. Here the connection's transports are switched over to
+BufferedProtocol relays: the kernel reads straight into one preallocated
+buffer per direction, a view of it goes to the peer transport's write(),
+and back-pressure is the transports' own pause/resume_writing callbacks.
+"""
+import asyncio
+import contextlib
+
+BUFFER_BYTES = 65536
+
+
+class RelayError(ConnectionError):
+    """A connection error while proxying; `backend` says whose socket failed.
+
+    Only backend failures count against the backend, and only they are worth
+    retrying elsewhere: a client that reset its connection is simply gone.
+    """
+
+    def __init__(self, exc, backend):
+        super().__init__(*exc.args)
+        self.backend = backend
+
+
+class _Relay(asyncio.BufferedProtocol):
+    """Everything its transport receives is written to `sink`."""
+
+    def __init__(self, sink, on_chunk, on_eof, done):
+        self.sink = sink
+        self.view = memoryview(bytearray(BUFFER_BYTES))
+        self.on_chunk = on_chunk
+        self.on_eof = on_eof
+        self.done = done
+
+    def get_buffer(self, sizehint):
+        return self.view
+
+    def buffer_updated(self, nbytes):
+        self.sink.write(self.view[:nbytes])
+        if self.sink.get_write_buffer_size():
+            # the transport may still reference our bytes: read on into a fresh buffer
+            self.view = memoryview(bytearray(BUFFER_BYTES))
+        if self.on_chunk:
+            self.on_chunk(nbytes)
+
+    def eof_received(self):
+        if self.on_eof:
+            self.on_eof()
+        self.sink.close()   # like the stream pump: one side done closes the other
+        return False
+
+    # our transport's write buffer is fed by the peer transport: throttle that one
+    def pause_writing(self):
+        self.sink.pause_reading()
+
+    def resume_writing(self):
+        self.sink.resume_reading()
+
+    def connection_lost(self, exc):
+        self.sink.close()
+        if not self.done.done():
+            self.done.set_result(exc)
+
+
+async def _take_over(reader, transport, proto):
+    # the peek's own bytes reach the backend as the caller's prefix; here we
+    # hand over what the StreamReader read past them, through its public API
+    transport.pause_reading()
+    transport.set_protocol(proto)
+    reader.feed_eof()   # it gets nothing more: read() returns what it holds
+    pending = b""
+    with contextlib.suppress(ConnectionError):
+        pending = await reader.read()
+    if pending:
+        proto.sink.write(pending)
+        if proto.on_chunk:
+            proto.on_chunk(len(pending))
+    if transport.is_closing():
+        proto.eof_received()
+        transport.close()
+        proto.connection_lost(None)
+    else:
+        # re-arms the socket, so an EOF the reader already saw is read again by proto
+        transport.resume_reading()
+
+
+async def relay(reader, writer, backend_reader, backend_writer, on_chunk=None, on_eof=None):
+    """Forward both directions until both are closed.
+
+    on_chunk(upstream, nbytes) and on_eof(upstream) see the same events the
+    stream pump reports. A connection error is raised at the end as a
+    RelayError, the backend's if both sides failed.
+    """
+    loop = asyncio.get_running_loop()
+    client, backend = writer.transport, backend_writer.transport
+    wrap = lambda fn, upstream: fn and (lambda *a: fn(upstream, *a))
+    up = _Relay(backend, wrap(on_chunk, True), wrap(on_eof, True), loop.create_future())
+    down = _Relay(client, wrap(on_chunk, False), wrap(on_eof, False), loop.create_future())
+    await _take_over(reader, client, up)
+    await _take_over(backend_reader, backend, down)
+    # up reads the client's transport, down the backend's
+    client_exc, backend_exc = await asyncio.gather(up.done, down.done)
+    if isinstance(backend_exc, ConnectionError):
+        raise RelayError(backend_exc, backend=True) from backend_exc
+    if isinstance(client_exc, ConnectionError):
+        raise RelayError(client_exc, backend=False) from client_exc
+
+
+async def pump(reader, writer, backend_reader, backend_writer, on_chunk=None, on_eof=None):
+    """PROXY_MODE=stream: read/write/drain in both directions, same callbacks
+    and RelayError as relay()."""
+    async def one_way(src, dst, upstream):
+        try:
+            while True:
+                try:
+                    data = await src.read(65536)
+                except ConnectionError as e:
+                    raise RelayError(e, backend=not upstream) from e
+                if not data:
+                    if on_eof:
+                        on_eof(upstream)
+                    break
+                try:
+                    dst.write(data)
+                    if on_chunk:
+                        on_chunk(upstream, len(data))
+                    await dst.drain()
+                except ConnectionError as e:
+                    raise RelayError(e, backend=upstream) from e
+        finally:
+            with contextlib.suppress(Exception):
+                dst.close()
+                await dst.wait_closed()
+
+    await asyncio.gather(one_way(reader, backend_writer, True),
+                         one_way(backend_reader, writer, False))
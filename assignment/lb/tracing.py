@@ -0,0 +1,64 @@
+"""Request tracing spans from the LB, exported in batches off the proxy path.
+
+A client that sets TRACING=1 opens its connection with a `TRACE <id>` line
+(the LB strips it, like a ROUTE hint) and passes the same id to the server
+inside the request. The LB records its own stages of that connection under
+the id; server.py and client.py record theirs, and trace_waterfall.py (in
+client/) stitches them into one timeline per request.
+
+Spans are flat dicts: trace, name, svc, ts (unix start), ms, plus string
+attributes. They go to the TRACE_STREAM Redis stream, or with
+TRACE_EXPORT=<path> to a JSON-lines file.
+"""
+import asyncio
+import json
+import os
+import socket
+import time
+
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "redis")                 # 'redis' or a JSON-lines file path
+TRACE_QUEUE = int(os.getenv("TRACE_QUEUE", "10000"))             # buffered spans; new ones are dropped beyond this
+TRACE_BATCH = int(os.getenv("TRACE_BATCH", "500"))               # spans per write
+
+TRACE_STREAM = "trace:spans"
+TRACE_STREAM_MAXLEN = 100000
+TRACE_PREFIX = b"TRACE "   # client preface line: b"TRACE <id>\n"
+
+
+class Spans:
+    def __init__(self, svc=None):
+        self.svc = svc or socket.gethostname()
+        self.queue = asyncio.Queue(maxsize=TRACE_QUEUE)
+        self.exported = 0
+        self.dropped = 0
+
+    def add(self, trace, name, start, end, **attrs):
+        """One finished stage; start/end are time.perf_counter() readings."""
+        span = {"trace": trace, "name": name, "svc": self.svc,
+                "ts": f"{time.time() - (time.perf_counter() - start):.6f}",
+                "ms": f"{(end - start) * 1000.0:.3f}"}
+        span.update((k, str(v)) for k, v in attrs.items())
+        try:
+            self.queue.put_nowait(span)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def flush_loop(self, redis_client):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < TRACE_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                if TRACE_EXPORT == "redis":
+                    async with redis_client.pipeline(transaction=False) as pipe:
+                        for span in batch:
+                            pipe.xadd(TRACE_STREAM, span, maxlen=TRACE_STREAM_MAXLEN, approximate=True)
+                        await pipe.execute()
+                else:
+                    with open(TRACE_EXPORT, "a") as f:
+                        f.writelines(json.dumps(span) + "\n" for span in batch)
+                self.exported += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                print(f"[LB] span export failed ({e}); dropped {len(batch)} span(s)", flush=True)
+                await asyncio.sleep(1.0)
@@ -0,0 +1,146 @@
+"""Chunked, multi-process counting for large data files.
+
+Files are cut into byte ranges that end just after an ASCII whitespace byte, so
+no `\\w+` token (and no keyword without whitespace) straddles two chunks, and a
+`\\b` at a chunk edge sees the same non-word neighbour it would in the whole
+text. Each worker reads only its own range (plus a keyword's length for
+keywords that contain whitespace), so nothing holds the full file. With
+COUNT_WORKERS=1 the same ranges are read one after another in-process.
+"""
+import os, re
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+CHUNK_BYTES = int(os.getenv("COUNT_CHUNK_BYTES", str(8 << 20)))            # bytes per work item
+WORKERS = int(os.getenv("COUNT_WORKERS", str(os.cpu_count() or 1)))        # process pool size; 1 = chunks run in-process
+PARALLEL_MIN_BYTES = int(os.getenv("PARALLEL_MIN_BYTES", str(32 << 20)))   # smaller files are read whole
+
+WORD_RE = re.compile(r"\w+")
+WS_RE = re.compile(rb"[ \t\n\r\f\v]")
+
+_pool = None
+
+def _executor() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn, not fork: the rpyc server is multi-threaded and forking it
+        # could copy a lock held by another thread
+        _pool = ProcessPoolExecutor(max_workers=WORKERS,
+                                    mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+def is_large(path: str) -> bool:
+    # large files always go through the chunked reader, with or without a pool
+    return os.path.getsize(path) >= PARALLEL_MIN_BYTES
+
+def _map(fn, ranges, *args):
+    # per-range results in order: from the process pool, or one range at a
+    # time in this process when there is a single worker
+    if WORKERS > 1:
+        futs = [_executor().submit(fn, path, s, e, *args) for path, s, e in ranges]
+        return (fut.result() for fut in futs)
+    return (fn(path, s, e, *args) for path, s, e in ranges)
+
+def chunk_ranges(path: str, chunk_bytes: int = CHUNK_BYTES):
+    size = os.path.getsize(path)
+    ranges, start = [], 0
+    with open(path, "rb") as f:
+        while start < size:
+            end = min(start + chunk_bytes, size)
+            if end < size:
+                end = _next_boundary(f, end, size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def _next_boundary(f, pos: int, size: int) -> int:
+    # first offset after an ASCII whitespace byte at or beyond pos
+    f.seek(pos)
+    while pos < size:
+        block = f.read(1 << 16)
+        if not block:
+            break
+        m = WS_RE.search(block)
+        if m:
+            return pos + m.end()
+        pos += len(block)
+    return size
+
+def _read_range(path: str, start: int, end: int) -> str:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(end - start).decode("utf-8", errors="ignore")
+
+def _tokenize_range(path: str, start: int, end: int) -> Counter:
+    return Counter(w.lower() for w in WORD_RE.findall(_read_range(path, start, end)))
+
+def _regex_range(path: str, start: int, end: int, keywords) -> list:
+    text = _read_range(path, start, end)
+    return [len(re.findall(rf"\b{re.escape(kw)}\b", text, flags=re.IGNORECASE))
+            for kw in keywords]
+
+def tokenize_file(path: str) -> Counter:
+    """Case-folded word -> count table for the whole file."""
+    total = Counter()
+    for counts in _map(_tokenize_range, [(path, s, e) for s, e in chunk_ranges(path)]):
+        total.update(counts)
+    return total
+
+def _spanning_range(path: str, start: int, end: int, keywords, overlap: int) -> list:
+    """Match entry points of whitespace-containing keywords in [start, end).
+
+    Such a match can start in this range and end in the next, so the worker
+    reads `overlap` bytes past `end`. findall() counts non-overlapping
+    matches, so how many land here depends on where the previous range's
+    last match ended: for each candidate start within one keyword length of
+    `start` (and the first one after), return (entry offset, count from
+    there, chars the last match runs past `end`), all in chars.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        own = f.read(end - start)
+        tail = f.read(overlap)
+    head = own.decode("utf-8", errors="ignore")
+    text = head + tail.decode("utf-8", errors="ignore")
+    out = []
+    for kw in keywords:
+        pat = re.compile(rf"(?=(\b{re.escape(kw)}\b))", flags=re.IGNORECASE)
+        cands = [(m.start(), m.end(1)) for m in pat.finditer(text) if m.start() < len(head)]
+        entries = []
+        for j, (s, _) in enumerate(cands):
+            if entries and entries[-1][0] >= len(kw):
+                break   # a carry is shorter than the keyword: later entries are never used
+            n, last = 0, 0
+            for cs, ce in cands[j:]:
+                if cs >= last:
+                    n, last = n + 1, ce
+            entries.append((s, n, max(0, last - len(head))))
+        out.append(entries)
+    return out
+
+def count_file(path: str, keywords) -> dict:
+    """Whole-word, case-insensitive counts with the same semantics as count_in_text."""
+    keywords = list(keywords)
+    unique = list(dict.fromkeys(kw.lower() for kw in keywords))   # each one scanned once
+    spanning = [kw for kw in unique if WS_RE.search(kw.encode())]
+    chunked = [kw for kw in unique if kw not in spanning]
+
+    counts = dict.fromkeys(unique, 0)
+    ranges = [(path, s, e) for s, e in chunk_ranges(path)]
+    if chunked:
+        for result in _map(_regex_range, ranges, chunked):
+            for kw, n in zip(chunked, result):
+                counts[kw] += n
+    if spanning:
+        # a keyword containing whitespace may cross a chunk edge: each worker
+        # reads past its range by the longest keyword (4 UTF-8 bytes a char,
+        # plus one char for the trailing \b), then the ranges are chained in order
+        overlap = 4 * (max(len(kw) for kw in spanning) + 1)
+        carry = dict.fromkeys(spanning, 0)   # chars the previous range's last match ran into this one
+        for result in _map(_spanning_range, ranges, spanning, overlap):
+            for kw, entries in zip(spanning, result):
+                entry = next((x for x in entries if x[0] >= carry[kw]), None)
+                counts[kw] += entry[1] if entry else 0
+                carry[kw] = entry[2] if entry else 0
+    return {kw: counts[kw.lower()] for kw in keywords}
@@ -1,45 +1,1082 @@
-import os, re, socket
+import os, re, sys, mmap, json, socket, struct, signal, asyncio, threading, time, functools, secrets, hashlib, atexit
+import contextlib, contextvars
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import rpyc
 from rpyc.utils.server import ThreadedServer
 import redis
+import parallel_count
 
 DATA_DIR   = os.getenv("DATA_DIR", "/app/data")
 REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 REDIS_DB   = int(os.getenv("REDIS_DB", "0"))
+INDEX_PRELOAD = bool(int(os.getenv("INDEX_PRELOAD", "1")))  # tokenize DATA_DIR at startup
+LOCAL_CACHE_SIZE = int(os.getenv("LOCAL_CACHE_SIZE", "4096"))  # 0 disables the in-process tier
+FILE_POLL_INTERVAL = float(os.getenv("FILE_POLL_INTERVAL", "2"))  # seconds between data file checks
+PATTERN_CACHE_SIZE = int(os.getenv("PATTERN_CACHE_SIZE", "1024"))  # compiled keyword regexes kept
+LEASE_MS = int(os.getenv("LEASE_MS", "2000"))            # cross-server compute lease on a missing key
+LEASE_POLL_MS = int(os.getenv("LEASE_POLL_MS", "10"))    # how often waiters re-check the key
+CACHE_TTL = int(os.getenv("CACHE_TTL", "86400"))         # seconds a file-version hash lives after its last read or write; 0 = no TTL
+CACHE_TTL_REFRESH = float(os.getenv("CACHE_TTL_REFRESH", "60"))  # a hash read from Redis gets its TTL reset at most this often
+MIGRATE_LEGACY_KEYS = bool(int(os.getenv("MIGRATE_LEGACY_KEYS", "1")))  # fold old count:* strings into hashes at startup
+WARM_TOP_N = int(os.getenv("WARM_TOP_N", "0"))               # precompute the N hottest keywords at startup; 0 = off
+WARM_CONCURRENCY = int(os.getenv("WARM_CONCURRENCY", "2"))   # warm-up worker threads
+WARM_BATCH = int(os.getenv("WARM_BATCH", "100"))             # keywords per warm-up task
+WARM_BLOCKING = bool(int(os.getenv("WARM_BLOCKING", "0")))   # finish warming before accepting connections
+HOT_FLUSH_INTERVAL = float(os.getenv("HOT_FLUSH_INTERVAL", "1"))  # seconds between hot_keywords flushes
+HOT_MAX_PENDING = int(os.getenv("HOT_MAX_PENDING", "10000"))     # distinct unflushed keywords that force an early flush
+SERVER_MODE = os.getenv("SERVER_MODE", "rpyc").lower()           # 'rpyc' (threaded) or 'async' (asyncio, JSON lines)
+ASYNC_REDIS_POOL = int(os.getenv("ASYNC_REDIS_POOL", "32"))      # redis.asyncio connections in async mode
+ASYNC_WORKERS = int(os.getenv("ASYNC_WORKERS", "8"))             # executor threads for counting in async mode
+BINARY_PORT = int(os.getenv("BINARY_PORT", "18862"))             # length-prefixed binary listener; 0 = off
+BINARY_MAX_FRAME = int(os.getenv("BINARY_MAX_FRAME", str(1 << 16)))  # largest request frame accepted
+REGISTRY = bool(int(os.getenv("REGISTRY", "0")))                 # heartbeat into the LB's backend registry
+REGISTRY_NAME = os.getenv("REGISTRY_NAME", socket.gethostname())  # registry member name; keeps its slot across restarts
+REGISTRY_ADDR = os.getenv("REGISTRY_ADDR", "")                   # host the LB should dial; default: this container's IP
+REGISTRY_HEARTBEAT = float(os.getenv("REGISTRY_HEARTBEAT", "2"))  # seconds between heartbeats
+REGISTRY_TTL = float(os.getenv("REGISTRY_TTL", "6"))             # LBs drop a backend silent this long (same on the LB)
+REGISTRY_DRAIN = float(os.getenv("REGISTRY_DRAIN", "5"))         # on SIGTERM: deregister, keep serving this long, exit
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "redis")                # spans of traced requests: 'redis' or a JSON-lines file path
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", "1"))  # seconds between span exports
+TRACE_MAX_PENDING = int(os.getenv("TRACE_MAX_PENDING", "10000"))  # unexported spans kept; newer ones are dropped
+
+HOT_KEY = "hot_keywords"  # sorted set: keyword -> request count (all servers)
+
+INVALIDATE_CHANNEL = "count:invalidate"  # pub/sub: filename whose counts are stale
+
+REGISTRY_KEY = "backends"            # sorted set: backend name -> last heartbeat (unix time)
+REGISTRY_ADDR_KEY = "backends:addr"  # hash: backend name -> "host:port" the LB dials
+REGISTRY_SLOT_KEY = "backends:slot"  # hash: backend name -> slot (its index in every LB's tables)
+
+TRACE_STREAM = "trace:spans"  # stream of span dicts from clients, LBs and servers (lb/tracing.py)
+TRACE_STREAM_MAXLEN = 100000
 
 r = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB, decode_responses=True)
 
+# claim a registry slot and heartbeat in one step. A name keeps its slot; a new
+# name (or one whose entry was flushed) gets its previous slot ARGV[4] back if
+# that is free, else the slot of a backend silent since ARGV[3], else the
+# lowest unused one.
+claim_slot = r.register_script("""
+local slot = redis.call('hget', KEYS[1], ARGV[1])
+if not slot then
+  local all = redis.call('hgetall', KEYS[1])
+  local taken = {}
+  for i = 2, #all, 2 do taken[all[i]] = true end
+  if ARGV[4] ~= '' and not taken[ARGV[4]] then
+    slot = ARGV[4]
+  end
+  for i = 1, #all, 2 do
+    if slot then break end
+    local seen = redis.call('zscore', KEYS[2], all[i])
+    if not seen or tonumber(seen) < tonumber(ARGV[3]) then
+      redis.call('hdel', KEYS[1], all[i])
+      redis.call('zrem', KEYS[2], all[i])
+      slot = all[i + 1]
+    end
+  end
+  if not slot then
+    local n = 0
+    while taken[tostring(n)] do n = n + 1 end
+    slot = tostring(n)
+  end
+  redis.call('hset', KEYS[1], ARGV[1], slot)
+end
+redis.call('zadd', KEYS[2], ARGV[2], ARGV[1])
+return tonumber(slot)
+""")
+
+# delete the lease only if we still own it
+release_lease = r.register_script(
+    "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+)
+
+WORD_RE = re.compile(r"\w+")
+NON_ASCII_RE = re.compile(rb"[\x80-\xff]")
+NON_ASCII_WORD_RE = re.compile(r"(?![\x00-\x7f])\w")
+
 def count_in_text(text: str, keyword: str) -> int:
     # whole-word, case-insensitive
     return len(re.findall(rf"\b{re.escape(keyword)}\b", text, flags=re.IGNORECASE))
 
+def read_text(path: str) -> str:
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read()
+
+@functools.lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def keyword_pattern(keyword: str):
+    # byte-level twin of count_in_text's pattern; only valid for ASCII keywords
+    return re.compile(rb"\b" + re.escape(keyword.encode("ascii")) + rb"\b", re.IGNORECASE)
+
+class FileMaps:
+    """Long-lived read-only mmaps of data files, remapped when a file changes.
+
+    Byte patterns only agree with the str regex when every word character in
+    the file is ASCII (bytes \\b and IGNORECASE are ASCII-only), so each map
+    carries an `ascii_safe` flag computed once when it is opened.
+    """
+
+    def __init__(self, data_dir: str):
+        self.data_dir = data_dir
+        self._maps = {}   # filename -> (mtime_ns, size, mmap | None, ascii_safe)
+        self._lock = threading.Lock()
+
+    def get(self, filename: str):
+        path = os.path.join(self.data_dir, filename)
+        st = os.stat(path)
+        entry = self._maps.get(filename)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2], entry[3]
+        with self._lock:
+            entry = self._maps.get(filename)
+            if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                return entry[2], entry[3]
+            mm, safe = None, True
+            if st.st_size:
+                with Span("server.file_read", file=filename, bytes=st.st_size, how="mmap"):
+                    with open(path, "rb") as f:
+                        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    safe = self._ascii_safe(mm)
+            # a replaced map is closed by GC once in-flight readers drop it
+            self._maps[filename] = (st.st_mtime_ns, st.st_size, mm, safe)
+            return mm, safe
+
+    @staticmethod
+    def _ascii_safe(mm) -> bool:
+        if NON_ASCII_RE.search(mm) is None:
+            return True
+        try:
+            text = mm[:].decode("utf-8")
+        except UnicodeDecodeError:
+            return False
+        return NON_ASCII_WORD_RE.search(text) is None
+
+    def count(self, filename: str, keywords) -> dict:
+        mm, safe = self.get(filename)
+        if mm is None:
+            return dict.fromkeys(keywords, 0)
+        out, text = {}, None
+        for kw in keywords:
+            if safe and kw.isascii():
+                out[kw] = sum(1 for _ in keyword_pattern(kw).finditer(mm))
+            else:
+                if text is None:
+                    text = mm[:].decode("utf-8", errors="ignore")
+                out[kw] = count_in_text(text, kw)
+        return out
+
+file_maps = FileMaps(DATA_DIR)
+
+def file_digest(path: str) -> str:
+    # content digest, identical on every server holding the same file
+    h = hashlib.blake2b(digest_size=8)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class WordIndex:
+    """Per-file case-folded word -> count table.
+
+    A keyword made only of word characters matches `\\b{kw}\\b` exactly when it
+    equals a whole `\\w+` run, so its count is a dict lookup. Tables are built
+    lazily (or at startup) and rebuilt when the file's mtime/size changes; each
+    carries a content digest that names the file version in the Redis cache.
+    """
+
+    def __init__(self, data_dir: str, on_change=None):
+        self.data_dir = data_dir
+        self.on_change = on_change  # called with (filename, old_version) when an indexed file changed
+        self._tables = {}   # filename -> (mtime_ns, size, Counter, version)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def indexable(keyword: str) -> bool:
+        return WORD_RE.fullmatch(keyword) is not None
+
+    def _entry(self, filename: str):
+        path = os.path.join(self.data_dir, filename)
+        st = os.stat(path)
+        entry = self._tables.get(filename)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry
+        with self._lock:
+            entry = self._tables.get(filename)
+            if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+                return entry
+            if parallel_count.is_large(path):
+                with Span("server.file_read", file=filename, bytes=st.st_size, how="chunked_tokenize"):
+                    counts = parallel_count.tokenize_file(path)
+            else:
+                with Span("server.file_read", file=filename, bytes=st.st_size):
+                    text = read_text(path)
+                with Span("server.tokenize", file=filename):
+                    counts = Counter(w.lower() for w in WORD_RE.findall(text))
+            fresh = self._tables[filename] = (st.st_mtime_ns, st.st_size, counts,
+                                              file_digest(path))
+        if entry and entry[3] != fresh[3] and self.on_change:
+            self.on_change(filename, entry[3])
+        return fresh
+
+    def table(self, filename: str) -> Counter:
+        return self._entry(filename)[2]
+
+    def version(self, filename: str) -> str:
+        return self._entry(filename)[3]
+
+    def count(self, filename: str, keyword: str) -> int:
+        if not self.indexable(keyword):
+            return self._regex_counts(filename, [keyword])[keyword]
+        return self.table(filename).get(keyword.lower(), 0)
+
+    def count_all(self, filename: str, keywords) -> dict:
+        # one tokenization (shared table) for plain words; keywords that need
+        # the \b...\b regex are scanned over the file's mmap
+        table = self.table(filename)
+        out, rest = {}, []
+        for kw in keywords:
+            if self.indexable(kw):
+                out[kw] = table.get(kw.lower(), 0)
+            else:
+                rest.append(kw)
+        if rest:
+            out.update(self._regex_counts(filename, rest))
+        return out
+
+    def _regex_counts(self, filename: str, keywords) -> dict:
+        path = os.path.join(self.data_dir, filename)
+        if parallel_count.is_large(path):
+            with Span("server.regex", file=filename, keywords=len(keywords), how="chunked"):
+                return parallel_count.count_file(path, keywords)
+        file_maps.get(filename)   # (re)map outside the regex span
+        with Span("server.regex", file=filename, keywords=len(keywords)):
+            return file_maps.count(filename, keywords)
+
+    def preload(self):
+        for name in sorted(os.listdir(self.data_dir)):
+            if os.path.isfile(os.path.join(self.data_dir, name)):
+                self.table(name)
+
+    def refresh(self):
+        # re-stat every indexed file; table() rebuilds and fires on_change
+        for name in list(self._tables):
+            try:
+                self.table(name)
+            except OSError:
+                self._tables.pop(name, None)
+
+class LocalCache:
+    """Bounded in-process LRU in front of the shared counts:* hashes."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()  # (filename, keyword) -> count
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filename: str, keyword: str):
+        key = (filename, keyword)
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, filename: str, keyword: str, count: int):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[(filename, keyword)] = count
+            self._data.move_to_end((filename, keyword))
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate_file(self, filename: str):
+        with self._lock:
+            for key in [k for k in self._data if k[0] == filename]:
+                del self._data[key]
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._data), "maxsize": self.maxsize,
+                    "hits": self.hits, "misses": self.misses}
+
+local_cache = LocalCache(LOCAL_CACHE_SIZE)
+
+def cache_key(filename: str, version: str = None) -> str:
+    # one hash per file version: field = case-folded keyword, value = count
+    return f"counts:{filename}:{version or index.version(filename)}"
+
+def store_counts(pipe, hkey: str, mapping: dict):
+    pipe.hset(hkey, mapping=mapping)
+    if CACHE_TTL > 0:
+        pipe.expire(hkey, CACHE_TTL)   # cold versions age out; Redis LFU handles memory pressure
+
+ttl_refreshed = {}   # hkey -> monotonic time this process last reset its TTL
+
+def refresh_ttl(pipe, hkey: str):
+    # reads keep a hash alive too, so a hot, fully cached one doesn't expire
+    # CACHE_TTL after its last write; one EXPIRE per CACHE_TTL_REFRESH is plenty
+    now = time.monotonic()
+    if CACHE_TTL > 0 and now - ttl_refreshed.get(hkey, -CACHE_TTL_REFRESH) >= CACHE_TTL_REFRESH:
+        ttl_refreshed[hkey] = now
+        pipe.expire(hkey, CACHE_TTL)
+
+def file_changed(filename: str, old_version: str):
+    # drop the old version's hash, then tell every server to drop its local copies
+    print(f"[server] {filename} changed; dropping cached counts for version {old_version}")
+    r.delete(cache_key(filename, old_version))
+    local_cache.invalidate_file(filename)
+    r.publish(INVALIDATE_CHANNEL, filename)
+
+def migrate_legacy_keys():
+    # fold pre-versioning count:{filename}:{keyword} strings into the current
+    # version hash of files we hold; legacy keys for unknown files are dropped
+    moved = dropped = 0
+    batch = []
+    for key in r.scan_iter(match="count:*", count=500):
+        batch.append(key)
+        if len(batch) >= 500:
+            m, d = _migrate_batch(batch)
+            moved, dropped, batch = moved + m, dropped + d, []
+    if batch:
+        m, d = _migrate_batch(batch)
+        moved, dropped = moved + m, dropped + d
+    if moved or dropped:
+        print(f"[server] migrated {moved} legacy count key(s), dropped {dropped}")
+
+def _migrate_batch(keys):
+    values = r.mget(keys)
+    per_file, dropped = {}, 0
+    for key, val in zip(keys, values):
+        parts = key.split(":", 2)
+        if len(parts) != 3 or val is None:
+            continue
+        _, filename, kw = parts
+        if os.path.isfile(os.path.join(DATA_DIR, filename)):
+            per_file.setdefault(filename, {})[kw] = val
+        else:
+            dropped += 1
+    pipe = r.pipeline(transaction=False)
+    for filename, mapping in per_file.items():
+        store_counts(pipe, cache_key(filename), mapping)
+    pipe.delete(*keys)
+    pipe.execute()
+    return sum(len(m) for m in per_file.values()), dropped
+
+def invalidation_loop():
+    while True:
+        try:
+            ps = r.pubsub(ignore_subscribe_messages=True)
+            ps.subscribe(INVALIDATE_CHANNEL)
+            for msg in ps.listen():
+                if msg.get("type") == "message":
+                    local_cache.invalidate_file(msg["data"])
+        except redis.RedisError as e:
+            print(f"[server] invalidation subscriber error: {e}; retrying")
+            time.sleep(1.0)
+
+def file_watch_loop():
+    while True:
+        time.sleep(FILE_POLL_INTERVAL)
+        try:
+            index.refresh()
+        except Exception as e:
+            print(f"[server] file watch error: {e}")
+
+deregistered = threading.Event()
+
+def register_loop(port: int):
+    # self-registration for LBs running with REGISTRY=1
+    name = REGISTRY_NAME
+    addr = f"{REGISTRY_ADDR or socket.gethostbyname(socket.gethostname())}:{port}"
+    slot = None
+    while not deregistered.is_set():
+        try:
+            now = time.time()
+            # every heartbeat re-asserts the address and slot, so a FLUSHALL or
+            # an eviction of the registry keys heals within one interval
+            pipe = r.pipeline(transaction=False)
+            pipe.hset(REGISTRY_ADDR_KEY, name, addr)
+            # slots of backends silent for 10 TTLs are free again
+            claim_slot(keys=[REGISTRY_SLOT_KEY, REGISTRY_KEY],
+                       args=[name, now, now - 10 * REGISTRY_TTL, "" if slot is None else slot],
+                       client=pipe)
+            claimed = pipe.execute()[1]
+            if claimed != slot:
+                print(f"[server] registered as {name} ({addr}) in slot {claimed}")
+                slot = claimed
+        except redis.RedisError as e:
+            print(f"[server] registry heartbeat failed: {e}")
+        deregistered.wait(REGISTRY_HEARTBEAT)
+
+def drain_and_exit(signum, frame):
+    # SIGTERM. In the registry, first look stale to the LBs at once, so they
+    # stop sending new connections, and keep serving what is in flight for
+    # REGISTRY_DRAIN seconds. The accept loop blocks signals out, so exit
+    # directly, flushing like atexit would (from a thread: the interrupted
+    # main thread may hold a lock the flush needs).
+    drain = 0.0
+    if REGISTRY:
+        drain = REGISTRY_DRAIN
+        print(f"[server] deregistering; exiting in {drain:.0f}s")
+        deregistered.set()
+        try:
+            r.zadd(REGISTRY_KEY, {REGISTRY_NAME: time.time() - REGISTRY_TTL})
+        except redis.RedisError as e:
+            print(f"[server] deregister failed: {e}")
+    def leave():
+        hot.flush()
+        spans.flush()
+        print("[server] drained; exiting", flush=True)
+        os._exit(0)
+    threading.Timer(drain, leave).start()
+
+index = WordIndex(DATA_DIR, on_change=file_changed)
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key: one runs, the rest wait for its result."""
+
+    def __init__(self):
+        self._calls = {}   # key -> [Event, result, error]
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None, None]
+        if not leader:
+            call[0].wait()
+            if call[2] is not None:
+                raise call[2]
+            return call[1]
+        try:
+            call[1] = fn()
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+        return call[1]
+
+single_flight = SingleFlight()
+
+def compute_miss(filename: str, keyword: str, hkey: str):
+    """Count an uncached keyword, letting one server compute while others wait.
+
+    Returns (count, from_cache); from_cache is True when another server's
+    result was picked up from Redis while we held off.
+    """
+    kw = keyword.lower()
+    lease = f"lease:{hkey}:{kw}"
+    token = secrets.token_hex(8)
+    if not r.set(lease, token, nx=True, px=LEASE_MS):
+        with Span("server.lease_wait", key=lease) as sp:
+            deadline = time.monotonic() + LEASE_MS / 1000.0
+            while time.monotonic() < deadline:
+                time.sleep(LEASE_POLL_MS / 1000.0)
+                cached = r.hget(hkey, kw)
+                if cached is not None:
+                    sp.attrs["outcome"] = "picked_up"
+                    return int(cached), True
+                if not r.exists(lease):
+                    break   # holder finished without writing or died: compute ourselves
+            sp.attrs["outcome"] = "compute"
+        token = None
+    try:
+        with Span("server.count", file=filename):
+            cnt = index.count(filename, keyword)
+        with Span("server.redis_write", key=hkey):
+            pipe = r.pipeline(transaction=False)
+            store_counts(pipe, hkey, {kw: cnt})         # cache result
+            pipe.execute()
+        return cnt, False
+    finally:
+        if token:
+            release_lease(keys=[lease], args=[token])
+
+def warm_cache(top_n: int = WARM_TOP_N, concurrency: int = WARM_CONCURRENCY):
+    """Precompute counts of the top-N hot_keywords for every file in DATA_DIR."""
+    t0 = time.perf_counter()
+    keywords = [kw for kw, _ in r.zrevrange(HOT_KEY, 0, top_n - 1, withscores=True)]
+    files = sorted(n for n in os.listdir(DATA_DIR) if os.path.isfile(os.path.join(DATA_DIR, n)))
+    tasks = [(f, keywords[i:i + WARM_BATCH]) for f in files
+             for i in range(0, len(keywords), WARM_BATCH)]
+    if not tasks:
+        print("[warm] nothing to warm (hot_keywords is empty)")
+        return 0
+
+    def warm_one(filename, batch):
+        hkey = cache_key(filename)
+        have = r.hmget(hkey, batch)
+        todo = [kw for kw, v in zip(batch, have) if v is None]
+        if todo:
+            counts = index.count_all(filename, todo)
+            pipe = r.pipeline(transaction=False)
+            store_counts(pipe, hkey, counts)
+            pipe.execute()
+            for kw, n in counts.items():
+                local_cache.put(filename, kw, n)
+        return len(todo)
+
+    computed = 0
+    print(f"[warm] {len(keywords)} keyword(s) x {len(files)} file(s), concurrency={concurrency}")
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as ex:
+        futs = [ex.submit(warm_one, f, b) for f, b in tasks]
+        for done, fut in enumerate(as_completed(futs), 1):
+            try:
+                computed += fut.result()
+            except Exception as e:
+                print(f"[warm] task failed: {e}")
+            print(f"[warm] {done}/{len(tasks)} tasks, {computed} count(s) computed", flush=True)
+    print(f"[warm] done in {time.perf_counter() - t0:.2f}s, {computed} count(s) computed")
+    return computed
+
+class HotKeywords:
+    """Per-process keyword request counts, flushed to HOT_KEY off the request path.
+
+    record() only bumps a local counter; a background thread ZINCRBYs the
+    accumulated deltas in one pipeline every HOT_FLUSH_INTERVAL seconds (or
+    sooner once HOT_MAX_PENDING distinct keywords are waiting).
+    """
+
+    def __init__(self):
+        self._pending = Counter()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self.flushes = 0
+        self.flush_errors = 0
+
+    def record(self, keyword: str, n: int = 1):
+        with self._lock:
+            self._pending[keyword] += n
+            full = len(self._pending) >= HOT_MAX_PENDING
+        if full:
+            self._wake.set()
+
+    def pending(self) -> Counter:
+        with self._lock:
+            return Counter(self._pending)
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, Counter()
+        if not batch:
+            return
+        try:
+            pipe = r.pipeline(transaction=False)
+            for kw, n in batch.items():
+                pipe.zincrby(HOT_KEY, n, kw)
+            pipe.execute()
+            self.flushes += 1
+        except redis.RedisError as e:
+            # put the deltas back; they go out with the next flush
+            self.flush_errors += 1
+            with self._lock:
+                self._pending.update(batch)
+            print(f"[server] hot keyword flush failed: {e}")
+
+    def flush_loop(self):
+        while True:
+            self._wake.wait(HOT_FLUSH_INTERVAL)
+            self._wake.clear()
+            self.flush()
+
+    def top(self, n: int):
+        # global leaderboard plus deltas this process has not flushed yet
+        pending = self.pending()
+        merged = dict(r.zrevrange(HOT_KEY, 0, n - 1, withscores=True))
+        extra = [kw for kw, _ in pending.most_common(n) if kw not in merged]
+        if extra:
+            for kw, score in zip(extra, r.zmscore(HOT_KEY, extra)):
+                merged[kw] = score or 0.0
+        for kw in merged:
+            merged[kw] += pending.get(kw, 0)
+        return sorted(merged.items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+hot = HotKeywords()
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Span:
+    """Time one stage of the current traced request (a `with` block).
+
+    Requests carry a trace id only when the client traces them; for all other
+    requests entering and leaving a Span costs a context variable lookup. The
+    outermost Span is given the request's trace id and makes it current for
+    everything it calls, including executor threads started through _offload.
+    Set `attrs` entries inside the block to annotate the span.
+    """
+    __slots__ = ("name", "attrs", "trace", "token", "start")
+
+    def __init__(self, name: str, trace: str = None, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.trace = str(trace)[:64] if trace else None
+        self.token = None
+
+    def __enter__(self):
+        if self.trace:
+            self.token = current_trace.set(self.trace)
+        else:
+            self.trace = current_trace.get()
+        if self.trace:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.trace:
+            if exc_type is not None:
+                self.attrs["error"] = exc_type.__name__
+            spans.add(self.trace, self.name, self.start, time.perf_counter(), self.attrs)
+        if self.token is not None:
+            current_trace.reset(self.token)
+
+class Spans:
+    """Finished spans of traced requests, exported off the request path.
+
+    Same shape as HotKeywords: add() appends under a lock, a background thread
+    ships the batch to TRACE_STREAM (or the TRACE_EXPORT file) every
+    TRACE_FLUSH_INTERVAL seconds. Spans past TRACE_MAX_PENDING are dropped
+    rather than queued without bound.
+    """
+
+    def __init__(self):
+        self._pending = []
+        self._lock = threading.Lock()
+        self.svc = socket.gethostname()
+        self.exported = 0
+        self.dropped = 0
+
+    def add(self, trace: str, name: str, start: float, end: float, attrs: dict):
+        span = {"trace": trace, "name": name, "svc": self.svc,
+                "ts": f"{time.time() - (time.perf_counter() - start):.6f}",
+                "ms": f"{(end - start) * 1000.0:.3f}"}
+        span.update((k, str(v)) for k, v in attrs.items())
+        with self._lock:
+            if len(self._pending) < TRACE_MAX_PENDING:
+                self._pending.append(span)
+                return
+        self.dropped += 1
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            if TRACE_EXPORT == "redis":
+                pipe = r.pipeline(transaction=False)
+                for span in batch:
+                    pipe.xadd(TRACE_STREAM, span, maxlen=TRACE_STREAM_MAXLEN, approximate=True)
+                pipe.execute()
+            else:
+                with open(TRACE_EXPORT, "a") as f:
+                    f.writelines(json.dumps(span) + "\n" for span in batch)
+            self.exported += len(batch)
+        except (redis.RedisError, OSError) as e:
+            # spans are best-effort: a failed batch is counted, not retried
+            self.dropped += len(batch)
+            print(f"[server] span export failed: {e}; dropped {len(batch)} span(s)")
+
+    def flush_loop(self):
+        while True:
+            time.sleep(TRACE_FLUSH_INTERVAL)
+            self.flush()
+
+spans = Spans()
+
+def readiness() -> dict:
+    """Deep health check: Redis answers and DATA_DIR has files to serve."""
+    problems = []
+    try:
+        r.ping()
+    except Exception as e:
+        problems.append(f"redis: {e}")
+    try:
+        files = [n for n in os.listdir(DATA_DIR) if os.path.isfile(os.path.join(DATA_DIR, n))]
+        if not files:
+            problems.append(f"no data files in {DATA_DIR}")
+    except OSError as e:
+        files = []
+        problems.append(f"data dir: {e}")
+    return {"ready": not problems, "data_files": len(files), "problems": problems,
+            "server": socket.gethostname()}
+
 class WordCountService(rpyc.Service):
     def exposed_ping(self):
         return "pong"
 
-    def exposed_count(self, filename: str, keyword: str):
-        key = f"count:{filename}:{keyword.lower()}"
-        cached = r.get(key)
-        if cached is not None:
-            r.zincrby("hot_keywords", 1, keyword.lower())
-            return {"count": int(cached), "from_cache": True, "server": socket.gethostname()}
+    def exposed_ready(self):
+        return readiness()
+
+    def exposed_count(self, filename: str, keyword: str, trace: str = None):
+        with Span("server.request", trace, file=filename, keyword=keyword) as req:
+            local = local_cache.get(filename, keyword.lower())
+            if local is not None:
+                hot.record(keyword.lower())
+                req.attrs["tier"] = "local"
+                return {"count": local, "from_cache": True, "server": socket.gethostname()}
 
-        path = os.path.join(DATA_DIR, filename)
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            text = f.read()
+            hkey = cache_key(filename)
+            with Span("server.redis_get", key=hkey):
+                pipe = r.pipeline(transaction=False)
+                pipe.hget(hkey, keyword.lower())
+                refresh_ttl(pipe, hkey)
+                cached = pipe.execute()[0]
+            if cached is not None:
+                local_cache.put(filename, keyword.lower(), int(cached))
+                hot.record(keyword.lower())
+                req.attrs["tier"] = "redis"
+                return {"count": int(cached), "from_cache": True, "server": socket.gethostname()}
 
-        cnt = count_in_text(text, keyword)
-        r.set(key, cnt)                                 # cache result
-        r.zincrby("hot_keywords", 1, keyword.lower())  # track “hot” keywords
-        return {"count": cnt, "from_cache": False, "server": socket.gethostname()}
+            with Span("server.compute"):
+                cnt, shared = single_flight.do((hkey, keyword.lower()),
+                                               lambda: compute_miss(filename, keyword, hkey))
+            local_cache.put(filename, keyword.lower(), cnt)
+            hot.record(keyword.lower())                 # track “hot” keywords
+            req.attrs["tier"] = "lease" if shared else "computed"
+            return {"count": cnt, "from_cache": shared, "server": socket.gethostname()}
+
+    def exposed_count_many(self, pairs):
+        # batch of (filename, keyword): one pipeline of HMGETs (one per file),
+        # one pipelined write-back. Returns a tuple of (count, from_cache, server)
+        # tuples so rpyc ships it by value instead of as a netref.
+        pairs = [(str(f), str(k)) for f, k in pairs]
+        if not pairs:
+            return ()
+        local = [local_cache.get(f, k.lower()) for f, k in pairs]
+        remote = [i for i, v in enumerate(local) if v is None]
+        wanted = {}   # hkey -> [pair index]
+        for i in remote:
+            wanted.setdefault(cache_key(pairs[i][0]), []).append(i)
+        cached = {}
+        if wanted:
+            pipe = r.pipeline(transaction=False)
+            for hkey, idxs in wanted.items():
+                pipe.hmget(hkey, [pairs[i][1].lower() for i in idxs])
+            for hkey in wanted:
+                refresh_ttl(pipe, hkey)             # after the HMGETs: zip() stops at their replies
+            for idxs, vals in zip(wanted.values(), pipe.execute()):
+                cached.update(zip(idxs, vals))
+
+        host = socket.gethostname()
+        out, misses = [], {}   # misses: hkey -> {keyword: count}
+        for i, (fname, kw) in enumerate(pairs):
+            if local[i] is not None:
+                out.append((local[i], True, host))
+                continue
+            val = cached[i]
+            if val is not None:
+                local_cache.put(fname, kw.lower(), int(val))
+                out.append((int(val), True, host))
+                continue
+            hkey = cache_key(fname)
+            found = misses.setdefault(hkey, {})
+            if kw.lower() not in found:
+                # same key as exposed_count, so single and batch misses coalesce;
+                # in-process only: the batch write-back is pipelined
+                found[kw.lower()], _ = single_flight.do((hkey, kw.lower()),
+                                                        lambda: (index.count(fname, kw), False))
+                local_cache.put(fname, kw.lower(), found[kw.lower()])
+            out.append((found[kw.lower()], False, host))
+
+        for _, kw in pairs:
+            hot.record(kw.lower())                      # track “hot” keywords
+        if misses:
+            pipe = r.pipeline(transaction=False)
+            for hkey, mapping in misses.items():
+                store_counts(pipe, hkey, mapping)       # cache results
+            pipe.execute()
+        return tuple(out)
+
+    def exposed_count_all(self, filename: str, keywords):
+        # counts for many keywords of one file, cached in a single pipeline
+        filename = str(filename)
+        keywords = list(dict.fromkeys(str(k) for k in keywords))
+        counts = index.count_all(filename, keywords)
+        if not counts:
+            return {}
+
+        pipe = r.pipeline(transaction=False)
+        store_counts(pipe, cache_key(filename), {kw.lower(): n for kw, n in counts.items()})
+        for kw in counts:
+            local_cache.put(filename, kw.lower(), counts[kw])
+            hot.record(kw.lower())
+        pipe.execute()
+        return counts
 
     def exposed_top_keywords(self, n: int = 5):
         # optional helper to show most requested keywords
-        return r.zrevrange("hot_keywords", 0, n-1, withscores=True)
+        return hot.top(n)
+
+    def exposed_cache_stats(self):
+        stats = local_cache.stats()
+        stats.update(hot_pending=len(hot.pending()), hot_flushes=hot.flushes,
+                     hot_flush_errors=hot.flush_errors)
+        return stats
+
+# Binary protocol (BINARY_PORT). Every message is a frame:
+#   frame    = u32 length | body                       (big-endian)
+#   request  = u32 id | u8 op | args
+#   response = u32 id | u8 status | payload            (status 0 = ok, 1 = error)
+#   str      = u16 length | utf-8 bytes
+# ops: OP_PING (no args, empty payload)
+#      OP_COUNT (str file | str keyword [| str trace]) -> u32 count | u8 from_cache | str server
+#      OP_READY (no args) -> str server; error status with the problems if not ready
+# Requests on one connection may be pipelined; replies carry the request id
+# and can come back in any order. An error payload is a single str.
+OP_PING, OP_COUNT, OP_READY = 1, 2, 3
+FRAME = struct.Struct(">I")
+HEAD = struct.Struct(">IB")
+COUNT_REPLY = struct.Struct(">IB")
+
+def pack_str(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack(">H", len(data)) + data
+
+def unpack_str(buf: bytes, off: int):
+    (n,) = struct.unpack_from(">H", buf, off)
+    return buf[off + 2:off + 2 + n].decode("utf-8"), off + 2 + n
+
+class AsyncWordCountService:
+    """asyncio twin of WordCountService.
+
+    With SERVER_MODE=async it serves newline-delimited JSON on SERVICE_PORT:
+    one request per line, e.g. {"op": "count", "file": "grail", "keyword": "king"},
+    one reply per line. It also serves the binary protocol on BINARY_PORT in
+    either mode. Cache lookups stay on the event loop with a pooled
+    redis.asyncio client; counting and miss coalescing run in an executor.
+    """
+
+    def __init__(self):
+        import redis.asyncio as aioredis
+        self.ar = aioredis.Redis(connection_pool=aioredis.ConnectionPool(
+            host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB,
+            max_connections=ASYNC_REDIS_POOL, decode_responses=True))
+        self.executor = ThreadPoolExecutor(max_workers=ASYNC_WORKERS)
+        self.host = socket.gethostname()
+
+    async def _offload(self, fn, *args):
+        # run in the caller's context so spans recorded in the executor find the trace id
+        ctx = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self.executor, ctx.run, fn, *args)
+
+    async def count(self, filename: str, keyword: str, trace: str = None):
+        with Span("server.request", trace, file=filename, keyword=keyword) as req:
+            kw = keyword.lower()
+            local = local_cache.get(filename, kw)
+            if local is not None:
+                hot.record(kw)
+                req.attrs["tier"] = "local"
+                return {"count": local, "from_cache": True, "server": self.host}
+
+            hkey = await self._offload(cache_key, filename)   # hashes the file on first use or change
+            with Span("server.redis_get", key=hkey):
+                async with self.ar.pipeline(transaction=False) as pipe:
+                    pipe.hget(hkey, kw)
+                    refresh_ttl(pipe, hkey)
+                    cached = (await pipe.execute())[0]
+            if cached is not None:
+                local_cache.put(filename, kw, int(cached))
+                hot.record(kw)
+                req.attrs["tier"] = "redis"
+                return {"count": int(cached), "from_cache": True, "server": self.host}
+
+            with Span("server.compute"):
+                cnt, shared = await self._offload(
+                    single_flight.do, (hkey, kw), lambda: compute_miss(filename, keyword, hkey))
+            local_cache.put(filename, kw, cnt)
+            hot.record(kw)
+            req.attrs["tier"] = "lease" if shared else "computed"
+            return {"count": cnt, "from_cache": shared, "server": self.host}
+
+    async def count_many(self, pairs):
+        pairs = [(str(f), str(k)) for f, k in pairs]
+        out = [None] * len(pairs)
+        misses = []
+        for i, (fname, kw) in enumerate(pairs):
+            hot.record(kw.lower())
+            local = local_cache.get(fname, kw.lower())
+            if local is not None:
+                out[i] = [local, True, self.host]
+            else:
+                misses.append(i)
+        if not misses:
+            return out
+
+        def keys():
+            # cache_key hashes a file on first use or after a change: not on the loop
+            wanted = {}   # hkey -> [pair index]
+            for i in misses:
+                wanted.setdefault(cache_key(pairs[i][0]), []).append(i)
+            return wanted
+        wanted = await self._offload(keys)
+
+        async with self.ar.pipeline(transaction=False) as pipe:
+            for hkey, idxs in wanted.items():
+                pipe.hmget(hkey, [pairs[i][1].lower() for i in idxs])
+            for hkey in wanted:
+                refresh_ttl(pipe, hkey)
+            replies = await pipe.execute()
+        todo = {}   # hkey -> {keyword: [pair index]}
+        for (hkey, idxs), vals in zip(wanted.items(), replies):
+            for i, val in zip(idxs, vals):
+                fname, kw = pairs[i]
+                if val is not None:
+                    local_cache.put(fname, kw.lower(), int(val))
+                    out[i] = [int(val), True, self.host]
+                else:
+                    todo.setdefault(hkey, {}).setdefault(kw.lower(), []).append(i)
+        if not todo:
+            return out
+
+        def compute():
+            def one(fname, kw):
+                return index.count(fname, kw), False
+            return {hkey: {kw: single_flight.do((hkey, kw), lambda: one(*pairs[idxs[0]]))[0]
+                           for kw, idxs in kws.items()}
+                    for hkey, kws in todo.items()}
+        found = await self._offload(compute)
+        async with self.ar.pipeline(transaction=False) as pipe:
+            for hkey, mapping in found.items():
+                store_counts(pipe, hkey, mapping)       # cache results
+                for kw, n in mapping.items():
+                    for i in todo[hkey][kw]:
+                        local_cache.put(pairs[i][0], kw, n)
+                        out[i] = [n, False, self.host]
+            await pipe.execute()
+        return out
+
+    async def dispatch(self, req: dict):
+        op = req.get("op")
+        if op == "ping":
+            return "pong"
+        if op == "ready":
+            return await self._offload(readiness)
+        if op == "count":
+            return await self.count(req["file"], req["keyword"], req.get("trace"))
+        if op == "count_many":
+            return await self.count_many(req["pairs"])
+        if op == "top_keywords":
+            return await self._offload(hot.top, int(req.get("n", 5)))
+        raise ValueError(f"unknown op {op!r}")
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    resp = await self.dispatch(json.loads(line))
+                except Exception as e:
+                    resp = {"error": str(e)}
+                writer.write(json.dumps(resp).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def binary_op(self, op: int, args: bytes) -> bytes:
+        if op == OP_PING:
+            return b""
+        if op == OP_COUNT:
+            fname, off = unpack_str(args, 0)
+            kw, off = unpack_str(args, off)
+            trace = unpack_str(args, off)[0] if off < len(args) else None
+            resp = await self.count(fname, kw, trace)
+            return COUNT_REPLY.pack(resp["count"], resp["from_cache"]) + pack_str(resp["server"])
+        if op == OP_READY:
+            state = await self._offload(readiness)
+            if not state["ready"]:
+                raise RuntimeError("; ".join(state["problems"]))
+            return pack_str(state["server"])
+        raise ValueError(f"unknown op {op}")
+
+    async def handle_binary(self, reader, writer):
+        write_lock = asyncio.Lock()
+        inflight = set()
+
+        async def run(rid, op, args):
+            try:
+                status, payload = 0, await self.binary_op(op, args)
+            except Exception as e:
+                status, payload = 1, pack_str(str(e))
+            body = HEAD.pack(rid, status) + payload
+            async with write_lock:   # one drain at a time per connection
+                with contextlib.suppress(ConnectionError):   # the client left: drop the reply
+                    writer.write(FRAME.pack(len(body)) + body)
+                    await writer.drain()
+
+        try:
+            while True:
+                try:
+                    (n,) = FRAME.unpack(await reader.readexactly(FRAME.size))
+                    if n < HEAD.size or n > BINARY_MAX_FRAME:
+                        break
+                    body = await reader.readexactly(n)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    break   # EOF (a half-close still wants its replies) or reset
+                rid, op = HEAD.unpack_from(body)
+                task = asyncio.create_task(run(rid, op, body[HEAD.size:]))
+                inflight.add(task)
+                task.add_done_callback(inflight.discard)
+        finally:
+            # answer everything already read before closing under it
+            if inflight:
+                await asyncio.gather(*inflight, return_exceptions=True)
+            writer.close()
+
+    async def serve(self, port: int = 0, binary_port: int = 0):
+        servers = []
+        if port:
+            servers.append(await asyncio.start_server(self.handle, host="0.0.0.0", port=port))
+        if binary_port:
+            servers.append(await asyncio.start_server(self.handle_binary, host="0.0.0.0",
+                                                      port=binary_port))
+        await asyncio.gather(*(srv.serve_forever() for srv in servers))
 
 if __name__ == "__main__":
     port = int(os.getenv("SERVICE_PORT", "18861"))
-    print(f"[server] starting on 0.0.0.0:{port}")
-    ThreadedServer(WordCountService, port=port,
-                   protocol_config={"allow_public_attrs": True}).start()
+    if INDEX_PRELOAD:
+        index.preload()
+        print(f"[server] indexed {len(index._tables)} file(s) in {DATA_DIR}")
+    if MIGRATE_LEGACY_KEYS:
+        migrate_legacy_keys()
+    if len(sys.argv) > 1 and sys.argv[1] == "warm":
+        # one-shot warm-up job: python server.py warm [top_n]
+        warm_cache(int(sys.argv[2]) if len(sys.argv) > 2 else (WARM_TOP_N or 100))
+        sys.exit(0)
+    if WARM_TOP_N > 0:
+        if WARM_BLOCKING:
+            warm_cache()
+        else:
+            threading.Thread(target=warm_cache, daemon=True).start()
+    threading.Thread(target=invalidation_loop, daemon=True).start()
+    threading.Thread(target=hot.flush_loop, daemon=True).start()
+    atexit.register(hot.flush)
+    threading.Thread(target=spans.flush_loop, daemon=True).start()
+    atexit.register(spans.flush)
+    threading.Thread(target=file_watch_loop, daemon=True).start()
+    if REGISTRY:
+        threading.Thread(target=register_loop, args=(port,), daemon=True).start()
+    signal.signal(signal.SIGTERM, drain_and_exit)   # docker stop: flush hot_keywords either way
+    print(f"[server] starting on 0.0.0.0:{port}  mode={SERVER_MODE}  binary_port={BINARY_PORT or 'off'}")
+    if SERVER_MODE == "async":
+        asyncio.run(AsyncWordCountService().serve(port, BINARY_PORT))
+    else:
+        if BINARY_PORT:
+            threading.Thread(target=lambda: asyncio.run(AsyncWordCountService().serve(0, BINARY_PORT)),
+                             daemon=True).start()
+        ThreadedServer(WordCountService, port=port,
+                       protocol_config={"allow_public_attrs": True}).start()